@@ -0,0 +1,129 @@
+"""
+Measures how much memory parsed routes take, both while a query is parsed and for the routes that are kept (e.g. in
+the route cache). The routing API is replaced by generated MVG-like responses, so no requests are sent.
+
+Usage: python -m benchmarks.route_memory [--queries 500] [--connections 8]
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from datetime import datetime, timedelta, UTC
+
+from commute_planner import route_api
+
+STATIONS = [
+    ("Garching, Forschungszentrum", "Garching (b München)", 48.2649, 11.6713),
+    ("Garching", "Garching (b München)", 48.2494, 11.6520),
+    ("Fröttmaning", "München", 48.2149, 11.6165),
+    ("Münchner Freiheit", "München", 48.1620, 11.5866),
+    ("Odeonsplatz", "München", 48.1429, 11.5775),
+    ("Marienplatz", "München", 48.1374, 11.5755),
+    ("Hauptbahnhof", "München", 48.1402, 11.5600),
+    ("Theresienstraße", "München", 48.1515, 11.5645),
+]
+LINES = [("UBAHN", "U6", "Garching, Forschungszentrum"), ("UBAHN", "U3", "Moosach"), ("BUS", "230", "Garching"),
+         ("SBAHN", "S8", "Flughafen München"), ("TRAM", "27", "Petuelring")]
+
+
+def stop(station: tuple, time: datetime) -> dict:
+    name, place, latitude, longitude = station
+    # Only a few of the fields the API actually sends are used, but all of them are parsed and kept
+    return {
+        "latitude": latitude, "longitude": longitude, "station": {"globalId": f"de:09162:{hash(name) % 10000}"},
+        "place": place, "name": name, "plannedDeparture": time.isoformat().replace("+00:00", "Z"),
+        "departureDelayInMinutes": 0, "arrivalDelayInMinutes": 0, "transportTypes": ["UBAHN", "BUS"],
+        "surroundingPlanLink": "BA", "occupancy": "LOW", "hasZoomData": True, "hasOutOfOrderEscalator": False,
+        "hasOutOfOrderElevator": False
+    }
+
+
+def connection(index: int, arrival: datetime, parts: int) -> dict:
+    route_parts = []
+    time = arrival - timedelta(minutes=9 * parts + index)
+    for i in range(parts):
+        line = LINES[(index + i) % len(LINES)]
+        departure, time = time, time + timedelta(minutes=8)
+        route_parts.append({
+            "from": stop(STATIONS[(index + i) % len(STATIONS)], departure),
+            "to": stop(STATIONS[(index + i + 1) % len(STATIONS)], time),
+            "intermediateStops": [stop(STATIONS[j % len(STATIONS)], departure + timedelta(minutes=2 * j))
+                                  for j in range(3)],
+            "noChangingRequired": False,
+            "line": {"label": line[1], "transportType": line[0], "destination": line[2], "trainType": "",
+                     "network": "swm", "divaId": "010U6", "sev": False},
+            "pathPolyline": "s|qdHy~`eA" * 20, "interchangePathPolyline": "", "pathDescription": [],
+            "exitLetter": "", "distance": 4321.0, "occupancy": "LOW", "messages": [], "infos": []
+        })
+        time += timedelta(minutes=1)
+    return {"uniqueId": index, "parts": route_parts, "ticketingInformation": {"zones": [1, 2], "alternativeZones": []},
+            "distance": 12345, "co2": 1.2}
+
+
+class FakeMvg:
+    """ Stands in for request_json, answering with generated responses """
+
+    def __init__(self, connections: int, parts: int) -> None:
+        self.connections = connections
+        self.parts = parts
+        # Responses are only kept while a single query is measured, so generating them isn't measured
+        self.memoize = True
+        self.responses = {}
+
+    def __call__(self, method, url, backend, params=None, **kwargs):
+        arrival = datetime.fromisoformat(params["routingDateTime"].replace("Z", "+00:00"))
+        if arrival in self.responses:
+            return self.responses[arrival]
+        response = [connection(i, arrival, self.parts) for i in range(self.connections)]
+        if self.memoize:
+            self.responses[arrival] = response
+        return response
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=500, help="number of route queries (kept routes)")
+    parser.add_argument("--connections", type=int, default=8, help="connections per response")
+    parser.add_argument("--parts", type=int, default=4, help="parts per connection")
+    args = parser.parse_args()
+
+    fake_mvg = FakeMvg(args.connections, args.parts)
+    route_api.request_json = fake_mvg
+    start = datetime(2030, 1, 7, 8, tzinfo=UTC)
+    origin, destination = (48.1374, 11.5755), (48.2649, 11.6713)
+
+    # Warm up (thread pool, responses), then measure a single query and the routes kept over many queries
+    route_api.find_route(origin, destination, start, "ARRIVAL", "MVG")
+    gc.collect()
+    tracemalloc.start()
+    route_api.find_route(origin, destination, start, "ARRIVAL", "MVG")
+    _, query_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    fake_mvg.memoize = False
+    fake_mvg.responses.clear()
+
+    gc.collect()
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    began = time.perf_counter()
+    kept = [route_api.find_route(origin, destination, start + timedelta(days=i // 8, minutes=i % 8 * 90),
+                                 "ARRIVAL", "MVG")
+            for i in range(args.queries)]
+    duration = time.perf_counter() - began
+    # Bounded caches aren't part of the kept routes
+    if hasattr(route_api, "parse_time"):
+        route_api.parse_time.cache_clear()
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert all(route is not None for route in kept)
+    print(f"Peak memory per query ({route_api.settings.ROUTE_SEARCH_WINDOWS} windows x {args.connections} "
+          f"connections): {query_peak / 1024:.1f} KiB")
+    print(f"Memory of {len(kept)} kept routes: {(current - baseline) / 1024:.1f} KiB "
+          f"({(current - baseline) / len(kept):.0f} B per route)")
+    print(f"Time per query: {duration / len(kept) * 1000:.2f} ms (with tracing, including generating the responses)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+Runs the planner against local stand-ins of all backends (see benchmarks/stand_ins.py) in realistic scenarios and
+reports wall time, CPU time, requests per backend and the peak (and retained) Python memory of every phase. Each
+scenario runs in a fresh process with empty caches, so the numbers are comparable across commits.
+
+Usage: python -m benchmarks.run [--scenario normal_week] [--latency 0] [--json results.json]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, date, timedelta
+from pathlib import Path
+
+REPOSITORY = Path(__file__).resolve().parent.parent
+
+# Weekly timetable: (weekday, start, minutes, summary, location)
+LECTURES = [
+    (0, "08:30", 90, "Analysis für Informatik [MA0902] VO", "MI HS 1, Friedrich L. Bauer Hörsaal (5606.EG.011)"),
+    (0, "10:15", 90, "Diskrete Strukturen [IN0015] ZÜ", "MW 0001, Gustav-Niemann-Hörsaal (5602.EG.001)"),
+    (0, "14:00", 90, "Einführung in die Informatik [IN0001] VO", "N1190 (0101.02.103)"),
+    (1, "10:00", 120, "Diskrete Strukturen [IN0015] VO", "MI HS 1, Friedrich L. Bauer Hörsaal (5606.EG.011)"),
+    (1, "13:15", 90, "Technische Mechanik [MW0001] VO", "MW 1801, Ernst-Schmidt-Hörsaal (5510.EG.001)"),
+    (2, "08:00", 90, "Biologie für Ingenieure [WZ0001] VO", "Hörsaal Weihenstephan (2906.EG.602)"),
+    (2, "12:15", 90, "Einführung in die Informatik [IN0001] ZÜ", "0505, Hörsaal (0505.EG.505)"),
+    (2, "16:00", 90, "Analysis für Informatik [MA0902] ZÜ", "MI HS 1, Friedrich L. Bauer Hörsaal (5606.EG.011)"),
+    (3, "09:45", 90, "Analysis für Informatik [MA0902] VO", "MI HS 1, Friedrich L. Bauer Hörsaal (5606.EG.011)"),
+    (3, "14:00", 90, "Einführung in die Informatik [IN0001] VO", "N1190 (0101.02.103)"),
+    (4, "08:30", 90, "Technische Mechanik [MW0001] ZÜ", "MW 0001, Gustav-Niemann-Hörsaal (5602.EG.001)"),
+    (4, "11:00", 60, "Diskrete Strukturen [IN0015] TUT", "0505, Hörsaal (0505.EG.505)"),
+]
+# Events of the main calendar, only route relevant ones are planned
+PERSONAL = [
+    (1, "18:30", 90, "Hochschulsport", "Olympiapark", "route_relevant"),
+    (3, "19:00", 120, "Kino", "Marienplatz", "route_relevant, margin_before=5"),
+    (4, "13:00", 120, "Lerngruppe", "tum:MI HS 1", "route_relevant"),
+    (5, "11:00", 240, "Familienbesuch", "latlon:48.39822, 11.72379", "route_relevant, db_routing"),
+]
+ROOMS = ["MI HS 1, Friedrich L. Bauer Hörsaal (5606.EG.011)", "MW 0001, Gustav-Niemann-Hörsaal (5602.EG.001)",
+         "N1190 (0101.02.103)", "0505, Hörsaal (0505.EG.505)", "MW 1801, Ernst-Schmidt-Hörsaal (5510.EG.001)"]
+
+SCENARIOS = {
+    # A typical week (the rest of this one and the next): the first planning and a check in which nothing changed
+    "normal_week": {"weeks": 1, "phases": ["cold", "steady"]},
+    # Lectures are moved around in the first weeks of the semester
+    "semester_start_reschedule": {"weeks": 2, "phases": ["cold", "reschedule"]},
+    # Planning the whole horizon at once
+    "horizon_8_weeks": {"weeks": 8, "phases": ["cold", "steady"]},
+}
+BACKENDS = ["MVG", "DB", "TUM", "GOOGLE", "GOOGLE (batched)"]
+
+
+def local_time(day: date, start: str, timezone) -> datetime:
+    hour, minute = map(int, start.split(":"))
+    return timezone.localize(datetime.combine(day, datetime.min.time()).replace(hour=hour, minute=minute))
+
+
+def event(day: date, start: str, minutes: int, summary: str, location: str, timezone, description="") -> dict:
+    begin = local_time(day, start, timezone)
+    return {"summary": summary, "location": location, "description": description,
+            "start": {"dateTime": begin.isoformat(), "timeZone": str(timezone)},
+            "end": {"dateTime": (begin + timedelta(minutes=minutes)).isoformat(), "timeZone": str(timezone)}}
+
+
+def fill_calendars(calendars, days: list[date]) -> None:
+    import pytz
+    from commute_planner import settings
+
+    timezone = pytz.timezone(settings.TIMEZONE)
+    for day in days:
+        for weekday, start, minutes, summary, location in LECTURES:
+            if day.weekday() == weekday:
+                calendars.put(settings.TUM_CALENDAR_ID, event(day, start, minutes, summary, location, timezone))
+        # The TUM calendar also lists streams of the lectures, they mustn't be planned
+        if day.weekday() == 0:
+            calendars.put(settings.TUM_CALENDAR_ID, event(day, "14:00", 90, LECTURES[2][3], "Online", timezone,
+                                                          "Videoübertragung aus N1190"))
+        for weekday, start, minutes, summary, location, description in PERSONAL:
+            if day.weekday() == weekday:
+                calendars.put(settings.MAIN_CALENDAR_ID,
+                              event(day, start, minutes, summary, location, timezone, description))
+
+
+def reschedule(calendars, share: float) -> None:
+    """ Moves a share of the lectures to another time or room, like the first weeks of a semester """
+    from commute_planner import settings
+
+    rng = random.Random(22)
+    for lecture in calendars.events(settings.TUM_CALENDAR_ID):
+        if "Videoübertragung" in lecture["description"] or rng.random() >= share:
+            continue
+        if rng.random() < 0.5:
+            lecture["location"] = rng.choice(ROOMS)
+        else:
+            for field in ("start", "end"):
+                moved = datetime.fromisoformat(lecture[field]["dateTime"]) + timedelta(hours=rng.choice([-2, 1, 2]))
+                lecture[field]["dateTime"] = moved.isoformat()
+        calendars.put(settings.TUM_CALENDAR_ID, lecture)
+
+
+class Probe:
+    """ Wraps the scheduler's callbacks, to know when a cycle is done """
+
+    def __init__(self, scheduler) -> None:
+        self.scheduler = scheduler
+        self.refreshes = 0
+        self.synced_days: list[set] = []
+        refresh, sync = scheduler.refresh, scheduler.sync
+
+        def counted_refresh(*args):
+            self.refreshes += 1
+            return refresh(*args)
+
+        def recorded_sync():
+            changed_days = sync()
+            self.synced_days.append(changed_days)
+            return changed_days
+
+        scheduler.refresh = counted_refresh
+        if sync is not None:
+            scheduler.sync = recorded_sync
+
+    def idle(self) -> bool:
+        heap = self.scheduler._heap
+        return not self.scheduler._in_flight and (not heap or heap[0].due > time.monotonic() + 1)
+
+    async def wait(self, refreshes: int, timeout: float = 600) -> None:
+        deadline = time.monotonic() + timeout
+        while self.refreshes < refreshes or not self.idle():
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Only {self.refreshes} of {refreshes} refreshes finished")
+            await asyncio.sleep(0.01)
+
+
+async def run_phases(phases: list[str], counter, calendars) -> list[dict]:
+    from commute_planner import main
+
+    scheduler = main.create_scheduler()
+    probe = Probe(scheduler)
+    horizon = scheduler.horizon()
+    fill_calendars(calendars, horizon)
+    counter.take()
+
+    results = []
+    task = None
+    for phase in phases:
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        wall, cpu, refreshes = time.perf_counter(), time.process_time(), probe.refreshes
+        if phase == "cold":
+            task = asyncio.create_task(scheduler.run())
+            expected = len(horizon)
+        elif phase == "steady":
+            # Every day is checked again, without any change to its events
+            scheduler.mark_changed(horizon)
+            expected = len(horizon)
+        elif phase == "reschedule":
+            reschedule(calendars, 0.3)
+            syncs = len(probe.synced_days)
+            scheduler.request_sync()
+            while len(probe.synced_days) == syncs:
+                await asyncio.sleep(0.01)
+            expected = len(probe.synced_days[-1] & set(horizon))
+        else:
+            raise ValueError(f"Unknown phase {phase}")
+        await probe.wait(refreshes + expected)
+        result = {
+            "phase": phase, "days": expected,
+            "wall_seconds": time.perf_counter() - wall, "cpu_seconds": time.process_time() - cpu,
+            "requests": counter.take(),
+        }
+        if tracemalloc.is_tracing():
+            # Python allocations only (e.g. not SQLite's), but the peak of this phase instead of the whole process
+            current, peak = tracemalloc.get_traced_memory()
+            result.update(peak_mib=peak / 2 ** 20, retained_mib=current / 2 ** 20)
+        results.append(result)
+
+    task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await task
+    return results
+
+
+def worker(scenario: str, latency: float, result_path: str, trace_memory: bool) -> None:
+    """ Runs a single scenario in this process, the planner's own output is discarded """
+    if trace_memory:
+        tracemalloc.start()
+    from googleapiclient import discovery
+
+    from commute_planner import calendar_client, settings, transport
+    from .stand_ins import CalendarStandIn, RequestCounter, RoutingStandIn
+
+    counter = RequestCounter()
+    routing = RoutingStandIn(counter, latency)
+    for prefix in ("https://www.mvg.de", "https://www.bahn.de", settings.TUM_API_URL):
+        transport.session.mount(prefix, routing)
+    calendars = CalendarStandIn(counter, latency, [
+        settings.TUM_CALENDAR_ID, settings.MAIN_CALENDAR_ID, settings.ROUTE_CALENDAR_ID])
+    calendar_client.build = lambda *args, **kwargs: discovery.build("calendar", "v3", http=calendars)
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        results = asyncio.run(run_phases(SCENARIOS[scenario]["phases"], counter, calendars))
+    with open(result_path, "w") as file:
+        json.dump(results, file)
+
+
+def run_scenario(scenario: str, latency: float) -> list[dict]:
+    with tempfile.TemporaryDirectory() as directory:
+        # Valid (fake) credentials, so the calendar client doesn't start the login flow
+        with open(os.path.join(directory, "token.json"), "w") as file:
+            json.dump({"token": "benchmark", "refresh_token": "benchmark", "client_id": "benchmark",
+                       "client_secret": "benchmark", "expiry": "2099-01-01T00:00:00Z"}, file)
+        env = dict(
+            os.environ,
+            PYTHONPATH=str(REPOSITORY),
+            USER_AGENT="benchmark", TUM_CALENDAR_ID="tum", MAIN_CALENDAR_ID="main", ROUTE_CALENDAR_ID="route",
+            TIME_MARGIN_BEFORE_IN_MINUTES="15", TIME_MARGIN_AFTER_IN_MINUTES="1",
+            HOME_LATITUDE="48.1545", HOME_LONGITUDE="11.5536", MIN_ROUTE_DISTANCE_IN_KM="0.3",
+            PRE_CALC_WEEK_COUNT=str(SCENARIOS[scenario]["weeks"]),
+            INCREMENTAL_SYNC="true", PUSH_NOTIFICATIONS="false", GTFS_FEED_PATH="",
+            SCHEDULER_MAX_REFRESHES_PER_HOUR="100000",
+            # The stand-ins don't rate limit, the request budgets would only measure their own pacing
+            MVG_REQUESTS_PER_MINUTE="0", DB_REQUESTS_PER_MINUTE="0", TUM_REQUESTS_PER_MINUTE="0",
+            GOOGLE_REQUESTS_PER_MINUTE="0",
+            LOCATION_CACHE_PATH=os.path.join(directory, "location_cache.sqlite3"),
+            TRAVEL_MATRIX_PATH=os.path.join(directory, "travel_matrix.sqlite3"),
+            PLANNER_STATE_PATH=os.path.join(directory, "planner_state.json.gz"),
+        )
+        # Tracing the memory slows the planner down several times, so it's measured in a second run of the scenario
+        runs = []
+        for trace_memory in (False, True):
+            result_path = os.path.join(directory, f"result_{len(runs)}.json")
+            subprocess.run([sys.executable, "-m", "benchmarks.run", "--worker", scenario, "--latency", str(latency),
+                            "--result", result_path] + (["--trace-memory"] if trace_memory else []),
+                           cwd=directory, env=env, check=True)
+            with open(result_path) as file:
+                runs.append(json.load(file))
+            for name in ("location_cache.sqlite3", "travel_matrix.sqlite3", "planner_state.json.gz"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(directory, name))
+        timed, traced = runs
+        for phase, memory in zip(timed, traced):
+            phase.update(peak_mib=memory["peak_mib"], retained_mib=memory["retained_mib"])
+        return timed
+
+
+def commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPOSITORY, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append",
+                        help="Scenario to run (repeatable, default: all)")
+    parser.add_argument("--latency", type=float, default=0, help="Simulated latency per request in milliseconds")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--worker", choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    parser.add_argument("--trace-memory", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker, args.latency / 1000, args.result, args.trace_memory)
+        return
+
+    results = {"commit": commit(), "latency_ms": args.latency, "scenarios": {}}
+    print(f"{'scenario':<27} {'phase':<11} {'days':>4} {'wall s':>7} {'cpu s':>7} {'peak MiB':>8} {'kept MiB':>8}  "
+          + " ".join(f"{backend:>8}" for backend in ("MVG", "DB", "TUM", "GOOGLE", "batched")))
+    for scenario in args.scenario or SCENARIOS:
+        results["scenarios"][scenario] = run_scenario(scenario, args.latency)
+        for phase in results["scenarios"][scenario]:
+            print(f"{scenario:<27} {phase['phase']:<11} {phase['days']:>4} {phase['wall_seconds']:>7.2f} "
+                  f"{phase['cpu_seconds']:>7.2f} {phase['peak_mib']:>8.1f} {phase['retained_mib']:>8.1f}  "
+                  + " ".join(f"{phase['requests'].get(backend, 0):>8}" for backend in BACKENDS))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+
+
+if __name__ == "__main__":
+    main()
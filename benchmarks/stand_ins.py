@@ -0,0 +1,239 @@
+"""
+Local stand-ins for the MVG, DB, nav.tum.de and Google Calendar APIs. They answer from the fixtures in
+benchmarks/fixtures (trimmed responses in the format of the real APIs, with their times shifted to the requested time)
+and count the requests per backend, so the planner runs completely offline.
+"""
+import copy
+import json
+import threading
+import time
+import urllib.parse
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, UTC
+from email import message_from_string
+from email.parser import FeedParser
+from pathlib import Path
+
+import httplib2
+import requests
+from requests.adapters import BaseAdapter
+
+FIXTURES = Path(__file__).parent / "fixtures"
+
+
+def load_fixture(name: str):
+    with open(FIXTURES / name, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def shift_times(data, delta: timedelta, keys: tuple):
+    """ Shifts all ISO times stored under one of the keys, so a fixture answers requests for any date """
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if key in keys and isinstance(value, str):
+                shifted = datetime.fromisoformat(value.replace("Z", "+00:00")) + delta
+                data[key] = shifted.isoformat().replace("+00:00", "Z") if value.endswith("Z") else shifted.isoformat()
+            else:
+                shift_times(value, delta, keys)
+    elif isinstance(data, list):
+        for value in data:
+            shift_times(value, delta, keys)
+    return data
+
+
+class RequestCounter:
+    def __init__(self) -> None:
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, backend: str, count: int = 1) -> None:
+        with self._lock:
+            self.counts[backend] += count
+
+    def take(self) -> dict:
+        with self._lock:
+            counts = dict(self.counts)
+            self.counts.clear()
+        return counts
+
+
+class RoutingStandIn(BaseAdapter):
+    """ Transport adapter for the shared requests session, answering like mvg.de, bahn.de and nav.tum.de """
+
+    def __init__(self, counter: RequestCounter, latency: float) -> None:
+        super().__init__()
+        self.counter = counter
+        self.latency = latency
+        self.mvg_connection = load_fixture("mvg_connection.json")
+        self.mvg_location = load_fixture("mvg_location.json")
+        self.db_fahrplan = load_fixture("db_fahrplan.json")
+        self.tum_rooms = load_fixture("tum_rooms.json")
+        self.tum_search = load_fixture("tum_search.json")
+
+    def send(self, request, **kwargs):
+        url = urllib.parse.urlsplit(request.url)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        time.sleep(self.latency)
+
+        if url.netloc == "www.mvg.de" and url.path == "/api/fib/v2/connection":
+            self.counter.add("MVG")
+            requested = datetime.fromisoformat(query["routingDateTime"].replace("Z", "+00:00"))
+            body = self._shifted(self.mvg_connection["connections"], self.mvg_connection["reference"], requested,
+                                 ("plannedDeparture",))
+        elif url.netloc == "www.mvg.de" and url.path == "/api/fib/v2/location":
+            self.counter.add("MVG")
+            body = self.mvg_location.get(query["query"], [])
+        elif url.netloc == "www.bahn.de":
+            self.counter.add("DB")
+            requested = datetime.fromisoformat(json.loads(request.body)["anfrageZeitpunkt"])
+            body = dict(self.db_fahrplan, verbindungen=self._shifted(
+                self.db_fahrplan["verbindungen"], self.db_fahrplan["reference"], requested,
+                ("abfahrtsZeitpunkt", "ankunftsZeitpunkt", "ezAbfahrtsZeitpunkt", "ezAnkunftsZeitpunkt")))
+        elif url.netloc == "nav.tum.de" and url.path == "/api/search":
+            self.counter.add("TUM")
+            body = self.tum_search
+        elif url.netloc == "nav.tum.de" and url.path.startswith("/api/get/"):
+            self.counter.add("TUM")
+            body = self.tum_rooms.get(urllib.parse.unquote(url.path[len("/api/get/"):]))
+            if body is None:
+                return self._response(request, 404, {"error": "not found"})
+        else:
+            raise requests.ConnectionError(f"No stand-in for {request.url}")
+        return self._response(request, 200, body)
+
+    @staticmethod
+    def _shifted(data, reference: str, requested: datetime, keys: tuple):
+        requested = requested.replace(tzinfo=requested.tzinfo or UTC)
+        return shift_times(copy.deepcopy(data), requested - datetime.fromisoformat(reference), keys)
+
+    @staticmethod
+    def _response(request, status: int, body) -> requests.Response:
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(body).encode()
+        response.headers["Content-Type"] = "application/json"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+class CalendarStandIn:
+    """
+    httplib2.Http replacement behind the googleapiclient Calendar service: lists (including sync tokens and paging),
+    inserts, patches and deletes events and executes batch requests
+    """
+
+    def __init__(self, counter: RequestCounter, latency: float, calendar_ids: list[str]) -> None:
+        self.counter = counter
+        self.latency = latency
+        self.calendars: dict[str, dict[str, dict]] = {calendar_id: {} for calendar_id in calendar_ids}
+        self.version = 0
+        self._lock = threading.RLock()
+
+    # Test data setup, without counting requests
+
+    def put(self, calendar_id: str, event: dict) -> dict:
+        with self._lock:
+            self.version += 1
+            now = datetime.now(UTC).isoformat()
+            event = {"kind": "calendar#event", "status": "confirmed", "created": now, "updated": now,
+                     "etag": f'"{self.version}"', **event, "_version": self.version}
+            event.setdefault("id", uuid.uuid4().hex)
+            self.calendars[calendar_id][event["id"]] = event
+            return event
+
+    def remove(self, calendar_id: str, event_id: str) -> None:
+        with self._lock:
+            self.version += 1
+            event = self.calendars[calendar_id][event_id]
+            event.update(status="cancelled", _version=self.version)
+
+    def events(self, calendar_id: str) -> list[dict]:
+        with self._lock:
+            return [event for event in self.calendars[calendar_id].values() if event["status"] != "cancelled"]
+
+    # httplib2 interface
+
+    def request(self, uri, method="GET", body=None, headers=None, *args, **kwargs):
+        time.sleep(self.latency)
+        self.counter.add("GOOGLE")
+        url = urllib.parse.urlsplit(uri)
+        if url.path == "/batch/calendar/v3":
+            return self._batch(body, headers)
+        status, content = self._handle(method, url.path, dict(urllib.parse.parse_qsl(url.query)), body)
+        return httplib2.Response({"status": str(status), "content-type": "application/json"}), content
+
+    def _handle(self, method: str, path: str, query: dict, body) -> tuple[int, bytes]:
+        segments = [urllib.parse.unquote(segment) for segment in path.split("/")]
+        # /calendar/v3/calendars/{calendarId}/events[/{eventId}]
+        calendar_id = segments[4]
+        event_id = segments[6] if len(segments) > 6 else None
+        with self._lock:
+            if calendar_id not in self.calendars:
+                return 404, b'{"error": {"code": 404, "message": "Not Found"}}'
+            if method == "GET" and event_id is None:
+                return 200, json.dumps(self._list(calendar_id, query)).encode()
+            if method == "POST" and event_id is None:
+                return 200, json.dumps(self._public(self.put(calendar_id, json.loads(body)))).encode()
+            event = self.calendars[calendar_id].get(event_id)
+            if event is None or event["status"] == "cancelled":
+                return 404, b'{"error": {"code": 404, "message": "Not Found"}}'
+            if method == "DELETE":
+                self.remove(calendar_id, event_id)
+                return 204, b""
+            if method == "PATCH":
+                self.version += 1
+                event.update(json.loads(body), updated=datetime.now(UTC).isoformat(), etag=f'"{self.version}"',
+                             _version=self.version)
+                return 200, json.dumps(self._public(event)).encode()
+        return 400, b'{"error": {"code": 400, "message": "Bad Request"}}'
+
+    def _list(self, calendar_id: str, query: dict) -> dict:
+        events = list(self.calendars[calendar_id].values())
+        if "syncToken" in query:
+            events = [event for event in events if event["_version"] > int(query["syncToken"])]
+        else:
+            events = [event for event in events if event["status"] != "cancelled"]
+            if "timeMin" in query:
+                time_min = datetime.fromisoformat(query["timeMin"].replace("Z", "+00:00"))
+                events = [event for event in events if datetime.fromisoformat(event["end"]["dateTime"]) > time_min]
+            if "timeMax" in query:
+                time_max = datetime.fromisoformat(query["timeMax"].replace("Z", "+00:00"))
+                events = [event for event in events if datetime.fromisoformat(event["start"]["dateTime"]) < time_max]
+        events.sort(key=lambda event: datetime.fromisoformat(event["start"]["dateTime"]))
+
+        start = int(query.get("pageToken", 0))
+        end = start + int(query.get("maxResults", 250))
+        result = {"kind": "calendar#events", "items": [self._public(event) for event in events[start:end]]}
+        if end < len(events):
+            result["nextPageToken"] = str(end)
+        else:
+            result["nextSyncToken"] = str(self.version)
+        return result
+
+    @staticmethod
+    def _public(event: dict) -> dict:
+        return {key: value for key, value in event.items() if not key.startswith("_")}
+
+    def _batch(self, body: str, headers: dict):
+        parser = FeedParser()
+        parser.feed(f"content-type: {headers['content-type']}\r\n\r\n{body}")
+        parts = []
+        for part in parser.close().get_payload():
+            request_line, rest = part.get_payload().split("\n", 1)
+            method, target, _ = request_line.strip().split(" ", 2)
+            sub_body = message_from_string(rest).get_payload()
+            target = urllib.parse.urlsplit(target)
+            status, content = self._handle(method, target.path, dict(urllib.parse.parse_qsl(target.query)),
+                                           sub_body or None)
+            self.counter.add("GOOGLE (batched)")
+            content_id = part["Content-ID"].replace("<", "<response-", 1)
+            parts.append(f"--batch\r\nContent-Type: application/http\r\nContent-ID: {content_id}\r\n\r\n"
+                         f"HTTP/1.1 {status} OK\r\nContent-Type: application/json\r\n\r\n{content.decode()}\r\n")
+        content = "".join(parts) + "--batch--"
+        return httplib2.Response({"status": "200", "content-type": 'multipart/mixed; boundary="batch"'}), \
+            content.encode()
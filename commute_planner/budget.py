@@ -0,0 +1,159 @@
+import functools
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, UTC
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+from .metrics import metrics
+from . import settings
+
+# Lower values are sent first. Refreshes of the upcoming route must not wait behind precomputations of far-future weeks
+PRIORITY_UPCOMING = 0
+PRIORITY_TODAY = 1
+PRIORITY_PRECOMPUTE = 1000
+
+_request_priority: ContextVar[int] = ContextVar("request_priority", default=PRIORITY_TODAY)
+
+
+def priority_for_day(days_ahead: int) -> int:
+    return PRIORITY_TODAY + max(days_ahead, 0)
+
+
+@contextmanager
+def request_priority(priority: int):
+    """ Requests sent within the block (in this thread or a copied context) are queued with the given priority """
+    token = _request_priority.set(priority)
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+
+def prioritized(priority: int, func):
+    """ Runs func with the given request priority, e.g. in another thread """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with request_priority(priority):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def current_priority() -> int:
+    return _request_priority.get()
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """ Retry-After is either a number of seconds or an HTTP date """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(UTC)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Request budget of a single backend: `rate` requests per second with bursts of up to `burst` requests. Waiting
+    requests are served by priority (then in order of arrival). Rate limit responses pause the backend and halve the
+    rate, which recovers step by step with every successful request
+    """
+
+    def __init__(self, backend: str, requests_per_minute: float, burst: int) -> None:
+        self.backend = backend
+        self.configured_rate = requests_per_minute / 60
+        self.rate = self.configured_rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.paused_until = 0.0
+        self._updated = time.monotonic()
+        self._waiting: list[tuple[int, int]] = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+
+    @property
+    def unlimited(self) -> bool:
+        return self.configured_rate <= 0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, priority: int, cost: int = 1) -> float:
+        """ Blocks until the request may be sent, returns the time it waited """
+        if self.unlimited:
+            return 0.0
+        start = time.monotonic()
+        # Requests that cost more than a whole burst (e.g. large batches) go into debt instead of waiting forever
+        required = min(cost, self.burst)
+        entry = (priority, next(self._order))
+        with self._condition:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while 1:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._waiting[0] != entry:
+                        self._condition.wait()
+                        continue
+                    delay = max(self.paused_until - now, (required - self.tokens) / self.rate)
+                    if delay <= 0:
+                        self.tokens -= cost
+                        return now - start
+                    self._condition.wait(delay)
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+
+    def succeeded(self) -> None:
+        if self.unlimited or self.rate >= self.configured_rate:
+            return
+        with self._condition:
+            self.rate = min(self.configured_rate, self.rate + self.configured_rate / 20)
+            self._condition.notify_all()
+
+    def throttle(self, retry_after: Optional[float]) -> None:
+        """ The backend reported that it is rate limiting us """
+        if self.unlimited:
+            return
+        with self._condition:
+            self._refill(time.monotonic())
+            pause = retry_after if retry_after is not None else settings.RATE_LIMIT_PAUSE
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            self.rate = max(self.rate / 2, self.configured_rate / 16)
+            # The requests already in flight have used up the burst
+            self.tokens = min(self.tokens, 0.0)
+            self._condition.notify_all()
+        print(f"[{self.backend}] Rate limited, pausing for {pause:.0f}s and slowing down to {
+            self.rate * 60:.1f} requests per minute")
+
+
+buckets = {
+    "MVG": TokenBucket("MVG", settings.MVG_REQUESTS_PER_MINUTE, settings.REQUEST_BURST),
+    "DB": TokenBucket("DB", settings.DB_REQUESTS_PER_MINUTE, settings.REQUEST_BURST),
+    "TUM": TokenBucket("TUM", settings.TUM_REQUESTS_PER_MINUTE, settings.REQUEST_BURST),
+    "GOOGLE": TokenBucket("GOOGLE", settings.GOOGLE_REQUESTS_PER_MINUTE, settings.REQUEST_BURST)
+}
+
+
+def throttle(backend: str, retry_after: Optional[float] = None) -> None:
+    metrics.increment("commute_planner_rate_limited_total", backend=backend)
+    buckets[backend].throttle(retry_after)
+
+
+metrics.describe("commute_planner_budget_wait_seconds", "Time requests waited for the backend's request budget")
+metrics.describe("commute_planner_rate_limited_total", "Rate limit responses (429, 403 or Retry-After) per backend")
+metrics.describe("commute_planner_budget_requests_per_minute", "Current request budget per backend (lowered after rate limits)")
+metrics.collector("commute_planner_budget_requests_per_minute", "gauge",
+                  lambda: [({"backend": backend}, bucket.rate * 60) for backend, bucket in buckets.items()])
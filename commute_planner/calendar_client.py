@@ -2,39 +2,75 @@ from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+import httplib2
 
 import os
+import threading
+import time
+
+from .budget import parse_retry_after, throttle
+from .concurrency import backend_limit
+from .metrics import metrics
+from .profiles import current_profile
+from .transport import backoff
 
 
 def singleton(cls):
     instances = {}
+    lock = threading.Lock()
 
     def _singleton(*args, **kwargs):
         if cls not in instances:
-            instances[cls] = cls(*args, **kwargs)
+            with lock:
+                if cls not in instances:
+                    instances[cls] = cls(*args, **kwargs)
         return instances[cls]
 
     return _singleton
 
 
-@singleton
+def per_profile(cls):
+    """ Like singleton, but with one instance per user profile (see profiles.current_profile) """
+    instances = {}
+    lock = threading.Lock()
+
+    def _per_profile(*args, **kwargs):
+        profile = current_profile()
+        if profile.name not in instances:
+            with lock:
+                if profile.name not in instances:
+                    instances[profile.name] = cls(*args, **kwargs)
+        return instances[profile.name]
+
+    return _per_profile
+
+
+@per_profile
 class CalendarClient:
     """ Class for simplifying the calendar client setup """
     SCOPES = ["https://www.googleapis.com/auth/calendar"]  # Full Access to all calendars
     creds: Credentials = None
-    service = None
 
     def __init__(self) -> None:
         self.creds = self._get_creds()
-        self.service = build("calendar", "v3", credentials=self.creds)
+        self._local = threading.local()
+
+    @property
+    def service(self):
+        # The underlying httplib2 connection isn't thread-safe, so every thread gets its own service
+        if getattr(self._local, "service", None) is None:
+            self._local.service = build("calendar", "v3", credentials=self.creds)
+        return self._local.service
 
     def _get_creds(self) -> Credentials:
         creds = None
-        # The file token.json stores the user's access and refresh tokens, and is
+        token_path = current_profile().token_path
+        # The file token.json (or the profile's token_path) stores the user's access and refresh tokens, and is
         # created automatically when the authorization flow completes for the first
         # time.
-        if os.path.exists("token.json"):
-            creds = Credentials.from_authorized_user_file("token.json", self.SCOPES)
+        if os.path.exists(token_path):
+            creds = Credentials.from_authorized_user_file(token_path, self.SCOPES)
         # If there are no (valid) credentials available, let the user log in.
         if not creds or not creds.valid:
             if creds and creds.expired and creds.refresh_token:
@@ -45,12 +81,110 @@ class CalendarClient:
                 )
                 creds = flow.run_local_server(port=0)
             # Save the credentials for the next run
-            with open("token.json", "w") as f:
+            if os.path.dirname(token_path):
+                os.makedirs(os.path.dirname(token_path), exist_ok=True)
+            with open(token_path, "w") as f:
                 f.write(creds.to_json())
 
         return creds
 
 
+# The API accepts up to 1000 requests per batch, but recommends (and rate limits) larger ones
+BATCH_SIZE = 50
+RETRYABLE_STATUS_CODES = {403, 429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = (b"rateLimitExceeded", b"userRateLimitExceeded", b"quotaExceeded")
+# Raised by httplib2 when the API can't be reached (e.g. DNS failures, refused or reset connections, timeouts)
+CONNECTION_ERRORS = (OSError, httplib2.HttpLib2Error)
+
+
+def is_rate_limited(exception: Exception) -> bool:
+    """ Google reports rate limits as 429 or as 403 with one of the RATE_LIMIT_REASONS """
+    if not isinstance(exception, HttpError):
+        return False
+    if exception.resp.status == 429:
+        return True
+    return exception.resp.status == 403 and any(reason in (exception.content or b"") for reason in RATE_LIMIT_REASONS)
+
+
+def throttle_google(exception: HttpError) -> None:
+    throttle("GOOGLE", parse_retry_after(exception.resp.get("retry-after")))
+
+
+def execute_request(request, max_retries: int = 3):
+    """
+    Executes a single request, retrying connection errors and rate limits with backoff. Rate limits also pause the
+    request budget of the calendar API (see budget.py)
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            with backend_limit("GOOGLE"):
+                return request.execute()
+        except (*CONNECTION_ERRORS, HttpError) as ex:
+            if isinstance(ex, HttpError) and not is_rate_limited(ex) or attempt == max_retries:
+                raise
+            if isinstance(ex, HttpError):
+                throttle_google(ex)
+            metrics.increment("commute_planner_backend_retries_total", backend="GOOGLE")
+            time.sleep(backoff(attempt))
+
+
+def execute_batch(requests: list, max_retries: int = 3) -> list:
+    """
+    Executes the given requests using batch requests, retrying only the failed sub-requests.
+    Returns the responses in the order of the requests (None for requests that failed)
+    """
+    responses = [None] * len(requests)
+    pending = list(range(len(requests)))
+
+    for attempt in range(max_retries + 1):
+        failed = []
+
+        def callback(request_id, response, exception):
+            index = int(request_id)
+            if exception is None:
+                responses[index] = response
+                return
+            reason = str(exception.resp.status) if isinstance(exception, HttpError) else type(exception).__name__
+            metrics.increment("commute_planner_backend_errors_total", backend="GOOGLE", reason=reason)
+            if is_rate_limited(exception):
+                throttle_google(exception)
+            if isinstance(exception, HttpError) and exception.resp.status in RETRYABLE_STATUS_CODES:
+                failed.append(index)
+            else:
+                print(f"Batch request {index} failed: {exception}")
+
+        for chunk_start in range(0, len(pending), BATCH_SIZE):
+            batch = CalendarClient().service.new_batch_http_request(callback=callback)
+            chunk = pending[chunk_start:chunk_start + BATCH_SIZE]
+            for index in chunk:
+                batch.add(requests[index], request_id=str(index))
+            try:
+                # Every sub-request counts against the API's rate limits
+                with backend_limit("GOOGLE", cost=len(chunk)):
+                    batch.execute()
+            except (*CONNECTION_ERRORS, HttpError) as ex:
+                # The whole chunk failed (e.g. the connection dropped), its sub-requests are retried
+                if isinstance(ex, HttpError) and ex.resp.status not in RETRYABLE_STATUS_CODES:
+                    raise
+                reason = str(ex.resp.status) if isinstance(ex, HttpError) else type(ex).__name__
+                metrics.increment("commute_planner_backend_errors_total", len(chunk), backend="GOOGLE",
+                                  reason=reason)
+                if is_rate_limited(ex):
+                    throttle_google(ex)
+                failed.extend(chunk)
+
+        if not failed:
+            break
+        if attempt == max_retries:
+            print(f"Giving up on {len(failed)} batch requests")
+            break
+        pending = sorted(failed)
+        metrics.increment("commute_planner_backend_retries_total", len(pending), backend="GOOGLE")
+        time.sleep(backoff(attempt))
+
+    return responses
+
+
 def bold(text: str) -> str:
     return f"\u003cb\u003e{text}\u003c/b\u003e"
 
@@ -0,0 +1,132 @@
+import threading
+from datetime import datetime, date, timedelta, UTC
+
+from googleapiclient.errors import HttpError
+
+from .calendar_client import CalendarClient, execute_request, per_profile
+from .profiles import current_profile
+
+
+def event_days(event) -> list[date]:
+    """ All (UTC) days an event overlaps, events without a start time (all-day events) aren't indexed """
+    if "dateTime" not in event.get("start", {}) or "dateTime" not in event.get("end", {}):
+        return []
+    start = datetime.fromisoformat(event["start"]["dateTime"]).astimezone(UTC)
+    end = datetime.fromisoformat(event["end"]["dateTime"]).astimezone(UTC)
+    days = []
+    day = start.date()
+    while day <= end.date():
+        if end > datetime.combine(day, datetime.min.time(), tzinfo=UTC):
+            days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+@per_profile
+class CalendarSync:
+    """ Local per-day index of calendar events, kept up to date using incremental sync tokens """
+
+    def __init__(self) -> None:
+        self.sync_tokens: dict[str, str] = {}
+        self.events: dict[str, dict[str, dict]] = {}
+        self.days: dict[str, dict[date, set[str]]] = {}
+        self._lock = threading.RLock()
+
+    def sync_all(self) -> set[date]:
+        """ Pulls the changes of all calendars, returns the days whose route relevant events changed """
+        changed_days = set()
+        for calendar_id in current_profile().calendar_ids:
+            calendar_changed_days = self.sync(calendar_id)
+            if calendar_id != current_profile().route_calendar_id:
+                changed_days |= calendar_changed_days
+        return changed_days
+
+    def sync(self, calendar_id: str) -> set[date]:
+        with self._lock:
+            self._prune(calendar_id)
+            try:
+                return self._sync(calendar_id)
+            except HttpError as ex:
+                # The sync token expired, the whole calendar has to be listed again
+                if ex.resp.status != 410:
+                    raise
+                print(f"[{calendar_id}] Sync token expired, doing a full sync")
+                self.sync_tokens.pop(calendar_id, None)
+                self.events.pop(calendar_id, None)
+                self.days.pop(calendar_id, None)
+                return self._sync(calendar_id)
+
+    def _sync(self, calendar_id: str) -> set[date]:
+        changed_days = set()
+
+        params = {"calendarId": calendar_id, "singleEvents": True, "maxResults": 2500}
+        if calendar_id in self.sync_tokens:
+            params["syncToken"] = self.sync_tokens[calendar_id]
+            params["showDeleted"] = True
+        else:
+            # Initial full sync, the past isn't relevant for route planning
+            params["timeMin"] = datetime.combine(date.today() - timedelta(days=1), datetime.min.time()).isoformat() + "Z"
+
+        page_token = None
+        while 1:
+            events_result = execute_request(CalendarClient().service.events().list(pageToken=page_token, **params))
+
+            for event in events_result.get("items", []):
+                changed_days |= self._remove(calendar_id, event["id"])
+                if event.get("status") == "cancelled":
+                    continue
+                changed_days |= self._add(calendar_id, event)
+
+            page_token = events_result.get("nextPageToken", None)
+            if page_token is None:
+                self.sync_tokens[calendar_id] = events_result["nextSyncToken"]
+                break
+
+        return changed_days
+
+    def _prune(self, calendar_id: str) -> None:
+        """ Drops the days before yesterday (like the initial sync) and the events that only took place on them """
+        first_day = date.today() - timedelta(days=1)
+        calendar_days = self.days.get(calendar_id, {})
+        past_event_ids = set()
+        for day in [day for day in calendar_days if day < first_day]:
+            past_event_ids |= calendar_days.pop(day)
+        calendar_events = self.events.get(calendar_id, {})
+        for event_id in past_event_ids:
+            event = calendar_events.get(event_id)
+            if event is not None and all(day < first_day for day in event_days(event)):
+                del calendar_events[event_id]
+
+    def _remove(self, calendar_id: str, event_id: str) -> set[date]:
+        old_event = self.events.setdefault(calendar_id, {}).pop(event_id, None)
+        if old_event is None:
+            return set()
+        calendar_days = self.days.setdefault(calendar_id, {})
+        for day in event_days(old_event):
+            calendar_days[day].discard(event_id)
+        return set(event_days(old_event))
+
+    def _add(self, calendar_id: str, event: dict) -> set[date]:
+        self.events.setdefault(calendar_id, {})[event["id"]] = event
+        calendar_days = self.days.setdefault(calendar_id, {})
+        for day in event_days(event):
+            calendar_days.setdefault(day, set()).add(event["id"])
+        return set(event_days(event))
+
+    def apply_writes(self, calendar_id: str, written_events: list, deleted_event_ids: list) -> None:
+        """
+        Puts our own inserts, patches and deletes into the index right away, so a refresh of the same day before the
+        next sync doesn't plan against the old events (and e.g. insert them again). The sync pulls them later anyway
+        """
+        with self._lock:
+            for event_id in deleted_event_ids:
+                self._remove(calendar_id, event_id)
+            for event in written_events:
+                self._remove(calendar_id, event["id"])
+                self._add(calendar_id, event)
+
+    def events_on(self, calendar_id: str, day: date) -> list:
+        with self._lock:
+            calendar_events = self.events.get(calendar_id, {})
+            events = [calendar_events[event_id] for event_id in self.days.get(calendar_id, {}).get(day, ())]
+        return sorted(events, key=lambda event: datetime.fromisoformat(event["start"]["dateTime"]))
@@ -0,0 +1,117 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from .budget import buckets, current_priority
+from .metrics import metrics
+from .profiles import current_profile
+from . import settings
+
+# Maximum number of simultaneous requests per backend, regardless of how many refresh workers are running
+BACKEND_LIMITS = {
+    "MVG": settings.MVG_CONCURRENCY,
+    "DB": settings.DB_CONCURRENCY,
+    "TUM": settings.TUM_CONCURRENCY,
+    "GOOGLE": settings.GOOGLE_CONCURRENCY
+}
+
+_semaphores = {backend: threading.BoundedSemaphore(limit) for backend, limit in BACKEND_LIMITS.items()}
+
+# Days are independent of each other, so they are refreshed concurrently by this pool
+day_executor = ThreadPoolExecutor(max_workers=settings.REFRESH_WORKER_COUNT, thread_name_prefix="refresh-day")
+# Search windows of a single route query, kept apart from the day executor so waiting days can't starve them
+search_executor = ThreadPoolExecutor(max_workers=(settings.REFRESH_WORKER_COUNT + 1) * settings.ROUTE_SEARCH_WINDOWS,
+                                     thread_name_prefix="route-search")
+
+
+class FairExecutor(Executor):
+    """
+    Thread pool shared by several users that takes turns between them (per profile, see profiles.current_profile),
+    so one user's backlog (e.g. the first planning of a whole semester) can't hold up everyone else's refreshes
+    """
+
+    def __init__(self, max_workers: int, thread_name_prefix: str) -> None:
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._queues: dict[str, deque] = {}
+        # Users with pending work, in the order they get their next turn
+        self._turns: deque[str] = deque()
+        self._threads: list[threading.Thread] = []
+        self._condition = threading.Condition()
+        self._shutdown = False
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        future = Future()
+        user = current_profile().name
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            if user not in self._queues:
+                self._queues[user] = deque()
+                self._turns.append(user)
+            self._queues[user].append((future, fn, args, kwargs))
+            if len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._work, name=f"{self.thread_name_prefix}_{len(self._threads)}",
+                                          daemon=True)
+                self._threads.append(thread)
+                thread.start()
+            self._condition.notify()
+        return future
+
+    def _work(self) -> None:
+        while 1:
+            with self._condition:
+                while not self._turns and not self._shutdown:
+                    self._condition.wait()
+                if not self._turns:
+                    return
+                user = self._turns.popleft()
+                future, fn, args, kwargs = self._queues[user].popleft()
+                if self._queues[user]:
+                    self._turns.append(user)
+                else:
+                    del self._queues[user]
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as ex:
+                future.set_exception(ex)
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait=True, *, cancel_futures=False) -> None:
+        with self._condition:
+            self._shutdown = True
+            if cancel_futures:
+                for queue in self._queues.values():
+                    for future, *_ in queue:
+                        future.cancel()
+                self._queues.clear()
+                self._turns.clear()
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+
+@contextmanager
+def backend_limit(backend: str, cost: int = 1):
+    """
+    Waits for the backend's request budget (by priority of the current context, see budget.request_priority) and then
+    for a free slot, `cost` is the number of requests sent (e.g. the sub-requests of a batch)
+    """
+    bucket = buckets[backend]
+    waited = bucket.acquire(current_priority(), cost)
+    metrics.observe("commute_planner_budget_wait_seconds", waited, backend=backend)
+    start = time.perf_counter()
+    with _semaphores[backend]:
+        acquired = time.perf_counter()
+        metrics.observe("commute_planner_backend_wait_seconds", acquired - start, backend=backend)
+        try:
+            yield
+            bucket.succeeded()
+        finally:
+            metrics.observe("commute_planner_backend_request_seconds", time.perf_counter() - acquired, backend=backend)
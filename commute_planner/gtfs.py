@@ -0,0 +1,452 @@
+import csv
+import io
+import itertools
+import math
+import os
+import threading
+import zipfile
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, date, timedelta
+from typing import Literal, Optional
+
+import pytz
+
+from .calendar_client import singleton
+from .route_api import Location, MovementType, Route, RoutePart
+from .spatial import fast_distance
+from . import settings
+
+INFINITY = 1 << 30
+
+# Extended route types (https://developers.google.com/transit/gtfs/reference/extended-route-types) are mapped by range
+ROUTE_TYPES = [
+    (0, 1, "TRAM"), (1, 2, "UBAHN"), (2, 3, "REGIONAL"), (3, 4, "BUS"), (4, 5, "SCHIFF"), (5, 8, "TRAM"),
+    (100, 109, "REGIONAL"), (109, 110, "SBAHN"), (110, 200, "REGIONAL"), (200, 300, "REGIONAL_BUS"),
+    (400, 500, "UBAHN"), (700, 715, "BUS"), (715, 716, "RUFTAXI"), (716, 800, "BUS"), (800, 900, "BUS"),
+    (900, 1000, "TRAM"), (1000, 1300, "SCHIFF"), (1500, 1600, "RUFTAXI")
+]
+
+
+def movement_type_for(route_type: int, name: str) -> str:
+    if route_type in (2, 100, 106) and name.startswith("S"):
+        return "SBAHN"
+    for start, end, movement_type in ROUTE_TYPES:
+        if start <= route_type < end:
+            return movement_type
+    return "UNKNOWN"
+
+
+def parse_time(value: str) -> int:
+    """ GTFS times are seconds after midnight of the service day and can exceed 24:00:00 """
+    hours, minutes, seconds = value.strip().split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+
+def counting_sort(keys: array, order=None) -> array:
+    """
+    Indices of the keys in ascending order of their key, keeping the given order (default: by index) among equal keys.
+    The keys are times of the day, so counting them needs far less memory than sorting objects
+    """
+    starts = array("i", bytes(4 * (max(keys, default=0) + 2)))
+    for key in keys:
+        starts[key + 1] += 1
+    for i in range(1, len(starts)):
+        starts[i] += starts[i - 1]
+    result = array("i", bytes(4 * len(keys)))
+    for index in order if order is not None else range(len(keys)):
+        key = keys[index]
+        result[starts[key]] = index
+        starts[key] += 1
+    return result
+
+
+def walking_seconds(a, b) -> int:
+    return int(fast_distance(a, b) * settings.GTFS_WALK_DETOUR_FACTOR / settings.GTFS_WALK_SPEED * 3600)
+
+
+@singleton
+class GtfsFeed:
+    """
+    Timetable of a GTFS feed as compact arrays of elementary connections (one per pair of consecutive stops of a trip),
+    searched with the Connection Scan Algorithm
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._active_trips: dict[date, bytearray] = {}
+        self.load(settings.GTFS_FEED_PATH)
+
+    @staticmethod
+    def _rows(path: str, name: str, required=True):
+        """ Rows of a file of the feed, which can be a directory or a zip archive """
+        try:
+            if os.path.isdir(path):
+                with open(os.path.join(path, name), encoding="utf-8-sig", newline="") as f:
+                    yield from csv.DictReader(f)
+            else:
+                with zipfile.ZipFile(path) as archive, archive.open(name) as f:
+                    yield from csv.DictReader(io.TextIOWrapper(f, encoding="utf-8-sig", newline=""))
+        except (FileNotFoundError, KeyError):
+            if required:
+                raise
+
+    def load(self, path: str) -> None:
+        print(f"Loading GTFS feed {path}")
+        # Stops
+        self.stop_names: list[str] = []
+        self.stop_lat = array("d")
+        self.stop_lon = array("d")
+        stop_index: dict[str, int] = {}
+        parents: dict[str, list[int]] = {}
+        for row in self._rows(path, "stops.txt"):
+            if not row.get("stop_lat") or not row.get("stop_lon"):
+                continue
+            stop_index[row["stop_id"]] = len(self.stop_names)
+            self.stop_names.append(row["stop_name"])
+            self.stop_lat.append(float(row["stop_lat"]))
+            self.stop_lon.append(float(row["stop_lon"]))
+            parents.setdefault(row.get("parent_station") or row["stop_id"], []).append(stop_index[row["stop_id"]])
+
+        # Footpaths with their walking time in seconds: platforms of the same station are connected by a short one,
+        # transfers.txt adds (or forbids) transfers between any stops, e.g. interchanges without a parent station
+        self.footpaths: dict[int, dict[int, int]] = {}
+        for stops in parents.values():
+            for stop in stops:
+                for other in stops:
+                    if other != stop:
+                        self.footpaths.setdefault(stop, {})[other] = settings.GTFS_TRANSFER_SECONDS
+        for row in self._rows(path, "transfers.txt", required=False):
+            # Transfers between specific trips or routes (and staying seated) aren't footpaths
+            if row.get("from_trip_id") or row.get("to_trip_id") or row.get("from_route_id") or \
+                    row.get("to_route_id") or row.get("transfer_type", "0") in ("4", "5"):
+                continue
+            # Transfers between stations apply to all of their platforms
+            from_stops = parents.get(row["from_stop_id"], [stop_index[row["from_stop_id"]]]
+                                     if row["from_stop_id"] in stop_index else [])
+            to_stops = parents.get(row["to_stop_id"], [stop_index[row["to_stop_id"]]]
+                                   if row["to_stop_id"] in stop_index else [])
+            for from_stop in from_stops:
+                for to_stop in to_stops:
+                    if from_stop == to_stop:
+                        continue
+                    if row.get("transfer_type") == "3":
+                        self.footpaths.get(from_stop, {}).pop(to_stop, None)
+                    elif row.get("min_transfer_time"):
+                        self.footpaths.setdefault(from_stop, {})[to_stop] = int(row["min_transfer_time"])
+                    else:
+                        self.footpaths.setdefault(from_stop, {})[to_stop] = max(
+                            settings.GTFS_TRANSFER_SECONDS,
+                            walking_seconds((self.stop_lat[from_stop], self.stop_lon[from_stop]),
+                                            (self.stop_lat[to_stop], self.stop_lon[to_stop])))
+        # Transfers can be one way, the backward search follows them from their end
+        self.incoming_footpaths: dict[int, dict[int, int]] = {}
+        for stop, others in self.footpaths.items():
+            for other, seconds in others.items():
+                self.incoming_footpaths.setdefault(other, {})[stop] = seconds
+
+        self._stop_grid: dict[tuple[int, int], list[int]] = {}
+        for stop in range(len(self.stop_names)):
+            self._stop_grid.setdefault(self._grid_cell(self.stop_lat[stop], self.stop_lon[stop]), []).append(stop)
+
+        # Routes and trips
+        route_index: dict[str, int] = {}
+        self.route_names: list[str] = []
+        self.route_movement_types: list[str] = []
+        for row in self._rows(path, "routes.txt"):
+            route_index[row["route_id"]] = len(self.route_names)
+            name = row.get("route_short_name") or row.get("route_long_name") or ""
+            self.route_names.append(name)
+            self.route_movement_types.append(movement_type_for(int(row["route_type"]), name))
+
+        service_index: dict[str, int] = {}
+        trip_index: dict[str, int] = {}
+        self.trip_route = array("i")
+        self.trip_service = array("i")
+        self.trip_headsigns: list[str] = []
+        for row in self._rows(path, "trips.txt"):
+            trip_index[row["trip_id"]] = len(self.trip_route)
+            self.trip_route.append(route_index[row["route_id"]])
+            self.trip_service.append(service_index.setdefault(row["service_id"], len(service_index)))
+            self.trip_headsigns.append(row.get("trip_headsign", ""))
+
+        # Service calendar
+        self.service_weekdays: dict[int, tuple] = {}
+        self.service_exceptions: dict[tuple[int, date], bool] = {}
+        weekdays = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+        for row in self._rows(path, "calendar.txt", required=False):
+            if row["service_id"] not in service_index:
+                continue
+            self.service_weekdays[service_index[row["service_id"]]] = (
+                tuple(row[weekday] == "1" for weekday in weekdays),
+                datetime.strptime(row["start_date"], "%Y%m%d").date(),
+                datetime.strptime(row["end_date"], "%Y%m%d").date()
+            )
+        for row in self._rows(path, "calendar_dates.txt", required=False):
+            if row["service_id"] not in service_index:
+                continue
+            self.service_exceptions[(service_index[row["service_id"]],
+                                     datetime.strptime(row["date"], "%Y%m%d").date())] = row["exception_type"] == "1"
+
+        # Connections, appended trip by trip straight into the columns. Feeds list the stop times grouped by trip (in
+        # practice, the spec doesn't require it), trips whose stop times are scattered across the file are read again
+        self.connection_departure = array("i")
+        self.connection_arrival = array("i")
+        self.connection_departure_stop = array("i")
+        self.connection_arrival_stop = array("i")
+        self.connection_trip = array("i")
+        seen_trips = bytearray(len(self.trip_route))
+        scattered_trips = set()
+        for trip, stop_times in self._trip_stop_times(path, stop_index, trip_index):
+            if seen_trips[trip]:
+                scattered_trips.add(trip)
+                continue
+            seen_trips[trip] = 1
+            self._append_connections(trip, stop_times)
+        if scattered_trips:
+            print(f"The stop times of {len(scattered_trips)} trips aren't grouped by trip, reading them again")
+            self._remove_connections(scattered_trips)
+            trips: dict[int, list[tuple[int, int, int, int]]] = {}
+            for trip, stop_times in self._trip_stop_times(path, stop_index, trip_index):
+                if trip in scattered_trips:
+                    trips.setdefault(trip, []).extend(stop_times)
+            for trip, stop_times in trips.items():
+                self._append_connections(trip, stop_times)
+            del trips
+
+        # Sorted by departure (ties by arrival, e.g. for connections without travel time, then in trip order) and a
+        # second order sorted by arrival for backward searches
+        order = counting_sort(self.connection_departure, counting_sort(self.connection_arrival))
+        for column in ("connection_departure", "connection_arrival", "connection_departure_stop",
+                       "connection_arrival_stop", "connection_trip"):
+            values = getattr(self, column)
+            setattr(self, column, array("i", (values[c] for c in order)))
+        del order
+        self.arrival_order = counting_sort(self.connection_arrival)
+        self.sorted_arrivals = array("i", (self.connection_arrival[c] for c in self.arrival_order))
+        print(f"Loaded {len(self.stop_names)} stops, {len(self.trip_route)} trips and {
+            len(self.connection_departure)} connections")
+
+    def _trip_stop_times(self, path: str, stop_index: dict[str, int], trip_index: dict[str, int]):
+        """ (trip, stop times) of each run of consecutive rows of the same trip in stop_times.txt """
+        trip, stop_times = None, []
+        for row in self._rows(path, "stop_times.txt"):
+            if row["stop_id"] not in stop_index or row["trip_id"] not in trip_index:
+                continue
+            if trip_index[row["trip_id"]] != trip:
+                if stop_times:
+                    yield trip, stop_times
+                trip, stop_times = trip_index[row["trip_id"]], []
+            stop_times.append((
+                int(row["stop_sequence"]),
+                parse_time(row["arrival_time"] or row["departure_time"]),
+                parse_time(row["departure_time"] or row["arrival_time"]),
+                stop_index[row["stop_id"]]
+            ))
+        if stop_times:
+            yield trip, stop_times
+
+    def _append_connections(self, trip: int, stop_times: list[tuple[int, int, int, int]]) -> None:
+        stop_times.sort()
+        for (_, _, departure, departure_stop), (_, arrival, _, arrival_stop) in zip(stop_times, stop_times[1:]):
+            self.connection_departure.append(departure)
+            self.connection_arrival.append(arrival)
+            self.connection_departure_stop.append(departure_stop)
+            self.connection_arrival_stop.append(arrival_stop)
+            self.connection_trip.append(trip)
+
+    def _remove_connections(self, trips: set[int]) -> None:
+        kept = [trip not in trips for trip in self.connection_trip]
+        for column in ("connection_departure", "connection_arrival", "connection_departure_stop",
+                       "connection_arrival_stop", "connection_trip"):
+            setattr(self, column, array("i", itertools.compress(getattr(self, column), kept)))
+
+    @staticmethod
+    def _grid_cell(lat: float, lon: float) -> tuple[int, int]:
+        return int(lat // 0.01), int(lon // 0.01)
+
+    def nearby_stops(self, coordinates) -> dict[int, int]:
+        """ Stops within walking distance, with the walking time in seconds """
+        lat_cells = math.ceil(settings.GTFS_MAX_WALK_DISTANCE / 1.11)
+        lon_cells = math.ceil(lat_cells / max(math.cos(math.radians(coordinates[0])), 0.01))
+        row, column = self._grid_cell(coordinates[0], coordinates[1])
+        stops = {}
+        for i in range(row - lat_cells, row + lat_cells + 1):
+            for j in range(column - lon_cells, column + lon_cells + 1):
+                for stop in self._stop_grid.get((i, j), ()):
+                    stop_coordinates = (self.stop_lat[stop], self.stop_lon[stop])
+                    if fast_distance(coordinates, stop_coordinates) <= settings.GTFS_MAX_WALK_DISTANCE:
+                        stops[stop] = walking_seconds(coordinates, stop_coordinates)
+        return stops
+
+    def active_trips(self, day: date) -> bytearray:
+        with self._lock:
+            if day not in self._active_trips:
+                services = set()
+                for service in set(self.trip_service):
+                    weekdays, start, end = self.service_weekdays.get(service, ((False,) * 7, day, day))
+                    active = start <= day <= end and weekdays[day.weekday()]
+                    if self.service_exceptions.get((service, day), active):
+                        services.add(service)
+                if len(self._active_trips) > 16:
+                    self._active_trips.clear()
+                self._active_trips[day] = bytearray(service in services for service in self.trip_service)
+            return self._active_trips[day]
+
+    def earliest_arrival(self, origin, destination, day: date, departure: int):
+        """ Forward connection scan, returns the journey as a list of legs or None """
+        active = self.active_trips(day)
+        arrivals = {stop: departure + walk for stop, walk in self.nearby_stops(origin).items()}
+        journeys = {stop: ("WALK",) for stop in arrivals}
+        targets = self.nearby_stops(destination)
+        boarded = {}
+        best_arrival, best_stop = INFINITY, None
+
+        def reached(stop, time):
+            nonlocal best_arrival, best_stop
+            if stop in targets and time + targets[stop] < best_arrival:
+                best_arrival, best_stop = time + targets[stop], stop
+
+        for c in range(bisect_left(self.connection_departure, departure), len(self.connection_departure)):
+            connection_departure = self.connection_departure[c]
+            if connection_departure >= best_arrival:
+                break
+            trip = self.connection_trip[c]
+            if not active[trip]:
+                continue
+            if trip not in boarded:
+                if arrivals.get(self.connection_departure_stop[c], INFINITY) > connection_departure:
+                    continue
+                boarded[trip] = c
+            stop, arrival = self.connection_arrival_stop[c], self.connection_arrival[c]
+            if arrival < arrivals.get(stop, INFINITY):
+                arrivals[stop] = arrival
+                journeys[stop] = ("TRIP", boarded[trip], c)
+                reached(stop, arrival)
+                for other, seconds in self.footpaths.get(stop, {}).items():
+                    if arrival + seconds < arrivals.get(other, INFINITY):
+                        arrivals[other] = arrival + seconds
+                        journeys[other] = ("TRANSFER", stop)
+                        reached(other, arrivals[other])
+
+        if best_stop is None:
+            return None
+        legs = []
+        stop = best_stop
+        while journeys[stop][0] != "WALK":
+            if journeys[stop][0] == "TRIP":
+                legs.insert(0, ("TRIP", journeys[stop][1], journeys[stop][2]))
+                stop = self.connection_departure_stop[journeys[stop][1]]
+            else:
+                legs.insert(0, ("TRANSFER", journeys[stop][1], stop))
+                stop = journeys[stop][1]
+        return stop, legs, best_stop, targets[best_stop]
+
+    def latest_departure(self, origin, destination, day: date, arrival: int):
+        """ Backward connection scan, returns the journey as a list of legs or None """
+        active = self.active_trips(day)
+        targets = self.nearby_stops(destination)
+        departures = {stop: arrival - walk for stop, walk in targets.items()}
+        journeys = {stop: ("WALK",) for stop in departures}
+        sources = self.nearby_stops(origin)
+        alighted = {}
+        best_departure, best_stop = -INFINITY, None
+
+        def reached(stop, time):
+            nonlocal best_departure, best_stop
+            if stop in sources and time - sources[stop] > best_departure:
+                best_departure, best_stop = time - sources[stop], stop
+
+        for k in range(bisect_right(self.sorted_arrivals, arrival) - 1, -1, -1):
+            c = self.arrival_order[k]
+            connection_arrival = self.connection_arrival[c]
+            if connection_arrival <= best_departure:
+                break
+            trip = self.connection_trip[c]
+            if not active[trip]:
+                continue
+            if trip not in alighted:
+                if departures.get(self.connection_arrival_stop[c], -INFINITY) < connection_arrival:
+                    continue
+                alighted[trip] = c
+            stop, departure = self.connection_departure_stop[c], self.connection_departure[c]
+            if departure > departures.get(stop, -INFINITY):
+                departures[stop] = departure
+                journeys[stop] = ("TRIP", c, alighted[trip])
+                reached(stop, departure)
+                for other, seconds in self.incoming_footpaths.get(stop, {}).items():
+                    if departure - seconds > departures.get(other, -INFINITY):
+                        departures[other] = departure - seconds
+                        journeys[other] = ("TRANSFER", stop)
+                        reached(other, departures[other])
+
+        if best_stop is None:
+            return None
+        legs = []
+        stop = best_stop
+        while journeys[stop][0] != "WALK":
+            if journeys[stop][0] == "TRIP":
+                legs.append(("TRIP", journeys[stop][1], journeys[stop][2]))
+                stop = self.connection_arrival_stop[journeys[stop][2]]
+            else:
+                legs.append(("TRANSFER", stop, journeys[stop][1]))
+                stop = journeys[stop][1]
+        return best_stop, legs, stop, targets[stop]
+
+    def _location(self, stop: int) -> Location:
+        return Location.create(self.stop_names[stop], "", (self.stop_lat[stop], self.stop_lon[stop]))
+
+    def build_route(self, origin, destination, day: date, journey) -> Optional[Route]:
+        first_stop, legs, last_stop, final_walk = journey
+        if not legs:
+            return None
+        midnight = pytz.timezone(settings.GTFS_TIMEZONE).localize(datetime.combine(day, datetime.min.time()))
+
+        def at(seconds: int) -> datetime:
+            return (midnight + timedelta(seconds=seconds)).astimezone(pytz.utc)
+
+        walk = MovementType.create("PEDESTRIAN", "Fußweg", "")
+        trips = [leg for leg in legs if leg[0] == "TRIP"]
+        if not trips:
+            return None
+
+        # (departure, arrival, from stop, to stop, movement type) in seconds after midnight
+        timeline = []
+        for i, leg in enumerate(legs):
+            if leg[0] == "TRIP":
+                _, board, alight = leg
+                trip = self.connection_trip[board]
+                timeline.append((
+                    self.connection_departure[board], self.connection_arrival[alight],
+                    self.connection_departure_stop[board], self.connection_arrival_stop[alight],
+                    MovementType.create(self.route_movement_types[self.trip_route[trip]],
+                                        self.route_names[self.trip_route[trip]], self.trip_headsigns[trip])
+                ))
+            else:
+                # Transfers are walked right after arriving, or right before departing if nothing was ridden yet
+                _, from_stop, to_stop = leg
+                seconds = self.footpaths[from_stop][to_stop]
+                departure = timeline[-1][1] if timeline else self.connection_departure[trips[0][1]] - seconds
+                timeline.append((departure, departure + seconds, from_stop, to_stop, walk))
+
+        first_walk = walking_seconds(origin, (self.stop_lat[first_stop], self.stop_lon[first_stop]))
+        parts = [RoutePart.create(at(timeline[0][0] - first_walk), at(timeline[0][0]),
+                                  Location.create("Start", "", origin), self._location(first_stop), walk)]
+        parts.extend(RoutePart.create(at(departure), at(arrival), self._location(from_stop), self._location(to_stop),
+                                      movement_type)
+                     for departure, arrival, from_stop, to_stop, movement_type in timeline)
+        parts.append(RoutePart.create(at(timeline[-1][1]), at(timeline[-1][1] + final_walk),
+                                      self._location(last_stop), Location.create("Ziel", "", destination), walk))
+        return Route(tuple(parts))
+
+    def route(self, origin, destination, time: datetime, type_: Literal["ARRIVAL", "DEPARTURE"]) -> Optional[Route]:
+        local_time = time.replace(tzinfo=time.tzinfo or pytz.utc).astimezone(pytz.timezone(settings.GTFS_TIMEZONE))
+        day = local_time.date()
+        seconds = local_time.hour * 3600 + local_time.minute * 60 + local_time.second
+        if type_ == "ARRIVAL":
+            journey = self.latest_departure(origin, destination, day, seconds)
+        else:
+            journey = self.earliest_arrival(origin, destination, day, seconds)
+        if journey is None:
+            return None
+        return self.build_route(origin, destination, day, journey)
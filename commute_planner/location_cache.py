@@ -0,0 +1,107 @@
+import functools
+import json
+import sqlite3
+import threading
+import time
+
+import requests
+
+from .calendar_client import singleton
+from .single_flight import SingleFlight
+from .transport import is_not_found
+from . import settings
+
+
+@singleton
+class LocationCache:
+    """ Disk-backed cache for resolved locations, keyed by resolver type and raw query """
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(settings.LOCATION_CACHE_PATH, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS locations ("
+            "resolver TEXT NOT NULL, "
+            "query TEXT NOT NULL, "
+            "coordinates TEXT, "
+            "expires_at REAL NOT NULL, "
+            "PRIMARY KEY (resolver, query))"
+        )
+        self._connection.commit()
+        # Expired rows are only replaced when their query is resolved again, the others are dropped on every start
+        self.purge_expired()
+
+    def get(self, resolver: str, query: str) -> tuple[bool, tuple | None]:
+        """ Returns (found, coordinates), coordinates being None for cached "not found" results """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT coordinates, expires_at FROM locations WHERE resolver = ? AND query = ?",
+                (resolver, query)
+            ).fetchone()
+            if row is None or row[1] < time.time():
+                self.misses += 1
+                return False, None
+            self.hits += 1
+        return True, tuple(json.loads(row[0])) if row[0] is not None else None
+
+    def set(self, resolver: str, query: str, coordinates: tuple | None) -> None:
+        ttl = settings.LOCATION_CACHE_TTL if coordinates is not None else settings.LOCATION_CACHE_NEGATIVE_TTL
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO locations (resolver, query, coordinates, expires_at) VALUES (?, ?, ?, ?)",
+                (resolver, query, json.dumps(coordinates) if coordinates is not None else None, time.time() + ttl)
+            )
+            self._connection.commit()
+
+    def purge_expired(self) -> None:
+        with self._lock:
+            self._connection.execute("DELETE FROM locations WHERE expires_at < ?", (time.time(),))
+            self._connection.commit()
+
+    @property
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+
+location_flight = SingleFlight()
+
+
+def cached_location(resolver: str):
+    """
+    Caches the result of a location resolver on disk. "Not found" (None or a 404) is cached with a shorter TTL,
+    failed requests are not cached at all.
+    """
+    def decorator(func):
+        def resolve(query: str):
+            cache = LocationCache()
+            found, coordinates = cache.get(resolver, query)
+            if found:
+                return coordinates
+
+            try:
+                coordinates = func(query)
+            except (requests.RequestException, ValueError) as ex:
+                print(ex)
+                if not is_not_found(ex):
+                    return None
+                # The resolver doesn't know the query (e.g. an unknown room), cached like any other "not found"
+                coordinates = None
+
+            cache.set(resolver, query, tuple(coordinates) if coordinates is not None else None)
+            return coordinates
+
+        @functools.wraps(func)
+        def wrapper(query: str):
+            # Concurrent lookups of the same location wait for the first one instead of querying again
+            return location_flight.do((resolver, query), resolve, query)
+
+        return wrapper
+
+    return decorator
@@ -1,13 +1,27 @@
 import asyncio
-import socket
+import functools
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta, UTC
-from typing import Optional
+from dataclasses import dataclass
+from typing import Literal, Optional
 
 import pytz
 import requests
 
-from .calendar_client import CalendarClient, bold, underlined
-from .route_api import get_route, Route
+from .calendar_client import CalendarClient, execute_batch, execute_request, bold, underlined
+from .calendar_sync import CalendarSync
+from .concurrency import day_executor
+from .push_notifications import PushNotifications
+from .scheduler import DayRefresh, RefreshScheduler
+from .location_cache import cached_location, LocationCache
+from .metrics import metrics
+from .planner_state import load_snapshot, save_snapshot
+from .profiles import current_profile
+from .route_api import get_route, route_cache, Route, RouteCache
+from .transport import request_json
+from .travel_matrix import TravelMatrix
 from . import settings
 
 
@@ -27,6 +41,7 @@ def remove_streams(events):
     return [event for event in events if "Videoübertragung" not in event.get("description", "")]
 
 
+@metrics.timed("get_location")
 def get_location(event):
     location_field = event.get("location", None)
     if location_field is None:
@@ -49,15 +64,14 @@ def get_location(event):
         return [float(elem) for elem in location_field[7:].split(", ")]
 
     # Try to interpret Location using MVG API
-    try:
-        response = requests.get("https://www.mvg.de/api/fib/v2/location", params={
-            "query": location_field
-        }, headers={"User-Agent": settings.USER_AGENT})
+    return get_mvg_location(location_field)
 
-        response_json = response.json()
-    except Exception as ex:
-        print(ex)
-        return None
+
+@cached_location("mvg")
+def get_mvg_location(query: str):
+    response_json = request_json("GET", "https://www.mvg.de/api/fib/v2/location", "MVG", params={
+        "query": query
+    })
 
     if (len(response_json) == 0 or
             response_json[0].get("latitude", None) is None is response_json[0].get("longitude", None)):
@@ -66,11 +80,13 @@ def get_location(event):
     return response_json[0]["latitude"], response_json[0]["longitude"]
 
 
+@cached_location("tum")
 def get_tum_location(query: str):
-    response = requests.get(
+    response_json = request_json(
+        "GET",
         f"{settings.TUM_API_URL}/api/search",
+        "TUM",
         headers={
-            "User-Agent": settings.USER_AGENT,
             "Accept": "application/json"
         },
         params={
@@ -80,7 +96,6 @@ def get_tum_location(query: str):
             "pre_highlight": ""
         }
     )
-    response_json = response.json()
     try:
         tum_id = response_json.get("sections", [{}])[0].get("entries", [{}])[0].get("id", None)
     except IndexError:
@@ -93,28 +108,25 @@ def get_tum_location(query: str):
     return get_tum_id_location(tum_id)
 
 
+@cached_location("tum_id")
 def get_tum_id_location(location_id: str):
-    try:
-        response = requests.get(
-            f"{settings.TUM_API_URL}/api/get/{location_id}",
-            headers={
-                "User-Agent": settings.USER_AGENT,
-                "Accept": "application/json"
-            }
-        )
-        response_json = response.json()
-    except Exception as ex:
-        print(ex)
-        return None
+    response_json = request_json(
+        "GET",
+        f"{settings.TUM_API_URL}/api/get/{location_id}",
+        "TUM",
+        headers={
+            "Accept": "application/json"
+        }
+    )
     coords = response_json.get("coords", None)
     if coords is None:
         return None
     return coords["lat"], coords["lon"]
 
 
-def get_events_on_day(day: date):
-    events_today = get_events_from_calendar(settings.TUM_CALENDAR_ID, day)
-    main_calendar_events = get_events_from_calendar(settings.MAIN_CALENDAR_ID, day)
+def get_events_on_day(day: date, consume=True):
+    events_today = get_events_from_calendar(current_profile().tum_calendar_id, day, consume)
+    main_calendar_events = get_events_from_calendar(current_profile().main_calendar_id, day, consume)
     home_override = {}
 
     for main_calendar_event in main_calendar_events:
@@ -140,16 +152,28 @@ def get_events_on_day(day: date):
     return events_today, home_override
 
 
-def get_events_from_calendar(calendar_id: str, day: date):
-    tum_calendar = calendar_id == settings.TUM_CALENDAR_ID
-    main_calendar = calendar_id == settings.MAIN_CALENDAR_ID
+@metrics.timed("get_events_from_calendar")
+def get_events_from_calendar(calendar_id: str, day: date, consume=True):
+    if settings.INCREMENTAL_SYNC:
+        return prepare_events(calendar_id, CalendarSync().events_on(calendar_id, day))
+    prefetched = (prefetched_events.pop if consume else prefetched_events.get)(
+        (current_profile().name, calendar_id, day), None)
+    if prefetched is not None:
+        return prefetched
+    return get_events_from_calendar_range(calendar_id, day, day)[day]
+
+
+def get_events_from_calendar_range(calendar_id: str, first_day: date, last_day: date) -> dict[date, list]:
+    """ Lists all events between first_day and last_day (inclusive) and buckets them by (UTC) day """
     calendar_client = CalendarClient()
 
-    time_min = datetime.combine(day, datetime.min.time())
-    time_max = datetime.combine(day, datetime.max.time())
+    time_min = datetime.combine(first_day, datetime.min.time())
+    time_max = datetime.combine(last_day, datetime.max.time())
 
-    try:
-        events_result = (
+    items = []
+    page_token = None
+    while 1:
+        events_result = execute_request(
             calendar_client.service.events()
             .list(
                 calendarId=calendar_id,
@@ -157,17 +181,39 @@ def get_events_from_calendar(calendar_id: str, day: date):
                 timeMax=time_max.isoformat() + "Z",
                 singleEvents=True,
                 orderBy="startTime",
+                maxResults=2500,
+                pageToken=page_token
             )
-            .execute()
         )
-    except socket.gaierror:
-        return get_events_from_calendar(calendar_id, day)
-
-    events = events_result.get("items", [])
-    if tum_calendar:
-        events = remove_streams(events_result.get("items", []))
-    elif main_calendar:
-        events = [event for event in events_result.get("items", []) if
+
+        items.extend(events_result.get("items", []))
+        page_token = events_result.get("nextPageToken", None)
+        if page_token is None:
+            break
+
+    events = prepare_events(calendar_id, items)
+
+    events_by_day = {first_day + timedelta(days=i): [] for i in range((last_day - first_day).days + 1)}
+    for event in events:
+        start = datetime.fromisoformat(event["start"]["dateTime"])
+        end = datetime.fromisoformat(event["end"]["dateTime"])
+        # Same semantics as a single day listing: the event overlaps [00:00Z, 23:59:59Z] of the day
+        day = max(start.date(), first_day)
+        while day <= min(end.date(), last_day):
+            if start < datetime.combine(day, datetime.max.time(), tzinfo=UTC) and \
+                    end > datetime.combine(day, datetime.min.time(), tzinfo=UTC):
+                events_by_day[day].append(event)
+            day += timedelta(days=1)
+    return events_by_day
+
+
+def prepare_events(calendar_id: str, items: list) -> list:
+    """ Filters the route relevant events of a calendar and normalizes their times to UTC """
+    events = items
+    if calendar_id == current_profile().tum_calendar_id:
+        events = remove_streams(items)
+    elif calendar_id == current_profile().main_calendar_id:
+        events = [event for event in items if
                   "route_relevant" in event.get("description", "") or
                   "home_override" in event.get("description", "") or
                   "home_disabled" in event.get("description", "") or
@@ -182,6 +228,36 @@ def get_events_from_calendar(calendar_id: str, day: date):
     return events
 
 
+# (profile name, calendar id, day) -> events, calendar ids like "primary" aren't unique across users
+prefetched_events: dict[tuple[str, str, date], list] = {}
+
+
+def prefetch_events(first_day: date, last_day: date):
+    """ Fetches the events of all calendars for a range of days at once, get_events_from_calendar consumes them """
+    if settings.INCREMENTAL_SYNC:
+        # The local index already covers every day, only the changes have to be pulled
+        CalendarSync().sync_all()
+        return
+    for calendar_id in current_profile().calendar_ids:
+        for day, events in get_events_from_calendar_range(calendar_id, first_day, last_day).items():
+            prefetched_events[(current_profile().name, calendar_id, day)] = events
+
+
+def prefetch_days(days: list[date]):
+    """ Prefetches the events of the given days, using a single listing per calendar """
+    first_day, last_day = min(days), max(days)
+    prefetch_events(first_day, last_day)
+    for i in range((last_day - first_day).days + 1):
+        if first_day + timedelta(days=i) not in days:
+            discard_prefetched_events(first_day + timedelta(days=i), first_day + timedelta(days=i))
+
+
+def discard_prefetched_events(first_day: date, last_day: date):
+    for calendar_id in current_profile().calendar_ids:
+        for i in range((last_day - first_day).days + 1):
+            prefetched_events.pop((current_profile().name, calendar_id, first_day + timedelta(days=i)), None)
+
+
 def get_metadata(event):
     split_flags = event.get("description", "").split("<br>")[0].split(", ")
     metadata = {}
@@ -195,85 +271,221 @@ def get_metadata(event):
     return metadata
 
 
-def get_routes_for_events(events_today, home_override):
-    routes = []
+def routing_api(time: datetime, *events_metadata) -> str:
+    if any(metadata.get("db_routing", False) for metadata in events_metadata):
+        return "DB"
+    # Far-future routes are planned offline, the live API is only needed closer to the departure (e.g. for delays)
+    if settings.GTFS_FEED_PATH and time - datetime.now(UTC) > timedelta(days=settings.GTFS_OFFLINE_AFTER_DAYS):
+        return "GTFS"
+    return "MVG"
+
+
+class EventMemo:
+    """ Resolves the location and metadata of each event only once per refresh """
+
+    def __init__(self) -> None:
+        self._locations = {}
+        self._metadata = {}
+
+    @staticmethod
+    def _key(event):
+        return event.get("id", None) or id(event)
+
+    def location(self, event):
+        key = self._key(event)
+        if key not in self._locations:
+            self._locations[key] = get_location(event)
+        return self._locations[key]
+
+    def metadata(self, event):
+        key = self._key(event)
+        if key not in self._metadata:
+            self._metadata[key] = get_metadata(event)
+        return self._metadata[key]
+
+
+# Flags that change how a route is planned, any other metadata doesn't require planning a route again
+ROUTE_RELEVANT_METADATA = ("arrive", "margin_before", "margin_after", "db_routing", "no_route")
+
+
+@dataclass
+class Leg:
+    """ A route the day needs, described by its route relevant inputs only (None is home) """
+    origin: Optional[dict]
+    destination: Optional[dict]
+    time: datetime
+    type_: Literal["ARRIVAL", "DEPARTURE"]
+    api_: str
+    home_pos: tuple
+
+    @property
+    def key(self) -> tuple[str, str]:
+        return (self.origin["id"] if self.origin is not None else "home",
+                self.destination["id"] if self.destination is not None else "home")
+
+    def _place(self, event) -> list:
+        if event is None:
+            return list(self.home_pos)
+        return [event.get("location", None),
+                {key: value for key, value in get_metadata(event).items() if key in ROUTE_RELEVANT_METADATA}]
+
+    @functools.cached_property
+    def fingerprint(self) -> str:
+        return hashlib.sha256(json.dumps([self._place(self.origin), self._place(self.destination),
+                                          self.time.isoformat(), self.type_, self.api_]).encode()).hexdigest()
+
+    @functools.cached_property
+    def recurrence_key(self) -> str:
+        """ Same for the legs of a weekly recurring lecture, which are planned once for all weeks """
+        local_time = self.time.astimezone(pytz.timezone(settings.TIMEZONE))
+        return hashlib.sha256(json.dumps([self._place(self.origin), self._place(self.destination),
+                                          local_time.weekday(), local_time.strftime("%H:%M:%S"),
+                                          self.type_, self.api_]).encode()).hexdigest()
+
+    def endpoints(self, memo: "EventMemo") -> Optional[tuple]:
+        origin = memo.location(self.origin) if self.origin is not None else self.home_pos
+        destination = memo.location(self.destination) if self.destination is not None else self.home_pos
+        if origin is None or destination is None:
+            return None
+        return origin, destination
+
+    def route(self, memo: "EventMemo") -> Optional[Route]:
+        endpoints = self.endpoints(memo)
+        if endpoints is None:
+            if self.origin is None:
+                print(f"[{self.time.strftime('%Y-%m-%d')}] Skipping route relevant event, because location data is missing")
+            return None
+        origin, destination = endpoints
+
+        if self.origin is not None and self.destination is not None:
+            # Leaves after the margin at the end of the first event, or arrives with the margin before the next one
+            departure, arrival = (self.time, datetime.fromisoformat(self.destination["start"]["dateTime"])) \
+                if self.type_ == "DEPARTURE" else (datetime.fromisoformat(self.origin["end"]["dateTime"]), self.time)
+            feasible = TravelMatrix().is_feasible(origin, destination, departure, arrival)
+        else:
+            feasible = None
+        if feasible is False:
+            print(f"[{self.time.strftime('%Y-%m-%d')}] {TerminalStyles.WARNING}Not enough time to get from {
+                self.origin.get('summary', '')} to {self.destination.get('summary', '')}{TerminalStyles.ENDC}")
+        return get_route(origin, destination, self.time, type_=self.type_, api_=self.api_)
+
+
+def leg_between_events(event1, event2, memo: EventMemo, home_pos=None) -> Optional[Leg]:
+    home_pos = home_pos if home_pos is not None else current_profile().home_pos
+    event1_metadata = memo.metadata(event1)
+    event2_metadata = memo.metadata(event2)
+
+    if event1_metadata.get("no_route", False) or event2_metadata.get("no_route", False):
+        return None
+
+    if event2_metadata.get("arrive", False):
+        margin_before = float(event2_metadata.get("margin_before", current_profile().time_margin_before))
+        arrival_time = datetime.fromisoformat(event2["start"]["dateTime"]) - timedelta(minutes=margin_before)
+        return Leg(event1, event2, arrival_time, "ARRIVAL",
+                   routing_api(arrival_time, event1_metadata, event2_metadata), home_pos)
+
+    margin_after = float(event1_metadata.get("margin_after", current_profile().time_margin_after))
+    departure_time = datetime.fromisoformat(event1["end"]["dateTime"]) + timedelta(minutes=margin_after)
+    return Leg(event1, event2, departure_time, "DEPARTURE",
+               routing_api(departure_time, event1_metadata, event2_metadata), home_pos)
+
+
+def plan_legs(events_today, home_override, memo: EventMemo = None) -> list[Leg]:
+    """ The routes the day needs, without resolving any location or querying any route """
+    memo = memo if memo is not None else EventMemo()
+    legs = []
     if len(events_today) == 0:
         return []
 
     home_pos = home_override.get("location", None) if home_override.get("location", None) is not None \
-        else settings.HOME_POS
+        else current_profile().home_pos
 
     if not home_override.get("disabled", False):
         # From home to first event
-        event_metadata = get_metadata(events_today[0])
+        event_metadata = memo.metadata(events_today[0])
         if not event_metadata.get("no_route", False):
-            margin_before = float(event_metadata.get("margin_before", settings.TIME_MARGIN_BEFORE))
+            margin_before = float(event_metadata.get("margin_before", current_profile().time_margin_before))
             arrival_time = (datetime.fromisoformat(events_today[0]["start"]["dateTime"]) -
                             timedelta(minutes=margin_before))
-            location_data = get_location(events_today[0])
-            if location_data is not None:
-                route = get_route(home_pos, location_data, arrival_time,
-                                  api_="DB" if event_metadata.get("db_routing", False) else "MVG")
-                if route is not None:
-                    routes.append(route)
-            else:
-                print(f"[{arrival_time.strftime('%Y-%m-%d')}] Skipping route relevant event, because location data is missing")
+            legs.append(Leg(None, events_today[0], arrival_time, "ARRIVAL",
+                            routing_api(arrival_time, event_metadata), tuple(home_pos)))
 
         # From last event to home
-        event_metadata = get_metadata(events_today[-1])
+        event_metadata = memo.metadata(events_today[-1])
         if not event_metadata.get("no_route", False):
-            margin_after = float(event_metadata.get("margin_after", settings.TIME_MARGIN_AFTER))
+            margin_after = float(event_metadata.get("margin_after", current_profile().time_margin_after))
             departure_time = (datetime.fromisoformat(events_today[-1]["end"]["dateTime"]) +
                               timedelta(minutes=margin_after))
-            location_data = get_location(events_today[-1])
-            if location_data is not None:
-                route = get_route(location_data, home_pos, departure_time, type_="DEPARTURE",
-                                  api_="DB" if event_metadata.get("db_routing", False) else "MVG")
-                if route is not None:
-                    routes.append(route)
+            legs.append(Leg(events_today[-1], None, departure_time, "DEPARTURE",
+                            routing_api(departure_time, event_metadata), tuple(home_pos)))
 
     # Routes between events
-    if len(events_today) == 1:
-        return routes
-
     for i in range(0, len(events_today) - 1):  # -1 because the last event doesn't have one after
-        route = route_between_events(events_today[i], events_today[i + 1])
-        if route is not None:
-            routes.append(route)
-
-    return routes
-
-
-def route_between_events(event1, event2) -> Optional[Route]:
-    event1_location = get_location(event1)
-    if event1_location is None:
-        return None
-    event2_location = get_location(event2)
-    if event2_location is None:
-        return None
-
-    event1_metadata = get_metadata(event1)
-    event2_metadata = get_metadata(event2)
-
-    if event1_metadata.get("no_route", False) or event2_metadata.get("no_route", False):
-        return None
-
-    if event2_metadata.get("arrive", False):
-        margin_before = float(event2_metadata.get("margin_before", settings.TIME_MARGIN_BEFORE))
-        arrival_time = datetime.fromisoformat(event2["start"]["dateTime"]) - timedelta(minutes=margin_before)
-
-        return get_route(event1_location, event2_location, arrival_time, type_="ARRIVAL",
-                         api_="DB" if event1_metadata.get("db_routing", False) or
-                                      event2_metadata.get("db_routing", False) else "MVG")
-
-    margin_after = float(event1_metadata.get("margin_after", settings.TIME_MARGIN_AFTER))
-    departure_time = datetime.fromisoformat(event1["end"]["dateTime"]) + timedelta(minutes=margin_after)
-    return get_route(event1_location, event2_location, departure_time, type_="DEPARTURE",
-                     api_="DB" if event1_metadata.get("db_routing", False) or
-                                  event2_metadata.get("db_routing", False) else "MVG")
-
-
-def add_route_to_calendar(route: Route):
+        leg = leg_between_events(events_today[i], events_today[i + 1], memo, tuple(home_pos))
+        if leg is not None:
+            legs.append(leg)
+
+    return legs
+
+
+def precompute_recurring_legs(days: dict[date, Optional[str]]):
+    """
+    Plans the legs of weekly recurring lectures once for all given days (with their known fingerprints) and fans the
+    route out to the other weeks through the route cache, so refreshing these days doesn't query the routing API again.
+    Legs that differ (e.g. moved lectures) are planned on their own as usual. Only legs without a route event yet get a
+    copy, events with a (provisional) route are replaced by their day's refresh once it expires, and days whose legs
+    didn't change since they were planned are skipped
+    """
+    memo = EventMemo()
+    groups: dict[str, list[Leg]] = {}
+    # Leg keys contain the ids of event instances, so they identify a leg across all the days
+    unplanned_keys = set()
+    for day, known_fingerprint in days.items():
+        events_today, home_override = get_events_on_day(day, consume=False)
+        legs = plan_legs(events_today, home_override, memo)
+        if day_fingerprint(legs) == known_fingerprint:
+            continue
+        planned_keys = {leg_key(event) for event in
+                        get_events_from_calendar(current_profile().route_calendar_id, day, consume=False)}
+        for leg in legs:
+            groups.setdefault(leg.recurrence_key, []).append(leg)
+            if leg.key not in planned_keys:
+                unplanned_keys.add(leg.key)
+
+    timezone = pytz.timezone(settings.TIMEZONE)
+    fanned_out = 0
+    for legs in groups.values():
+        legs.sort(key=lambda leg: leg.time)
+        if len(legs) < 2 or not any(leg.key in unplanned_keys for leg in legs[1:]):
+            continue
+        endpoints = legs[0].endpoints(memo)
+        if endpoints is None:
+            continue
+        try:
+            route = legs[0].route(memo)
+        except (requests.RequestException, ValueError) as ex:
+            # The days plan this leg on their own, and fail (to be retried) if the API is still down
+            print(f"Couldn't plan a recurring leg: {ex}")
+            continue
+        if route is None:
+            continue
+        for leg in legs[1:]:
+            if leg.key not in unplanned_keys:
+                continue
+            key = RouteCache.key(*endpoints, leg.time, leg.type_, leg.api_)
+            if route_cache.get(key)[0]:
+                continue
+            # Same local time in another week, which isn't a multiple of 7 days if daylight saving time changed
+            utc_offset_change = (leg.time.astimezone(timezone).utcoffset() -
+                                 legs[0].time.astimezone(timezone).utcoffset())
+            copy = route.shifted(int((leg.time - legs[0].time).total_seconds()), int(utc_offset_change.total_seconds()))
+            route_cache.set(key, copy, RouteCache.ttl(leg.time, copy))
+            fanned_out += 1
+    if fanned_out:
+        print(f"Planned {fanned_out} recurring legs without querying a route")
+
+
+def route_to_event(route: Route, leg: Leg = None) -> dict:
     event = {
         'summary': f"{route.calendar_summary}",
         'location': str(route.parts[-1].end),
@@ -291,11 +503,28 @@ def add_route_to_calendar(route: Route):
         },
         'sendUpdates': "all"
     }
-
-    event = CalendarClient().service.events().insert(calendarId=settings.ROUTE_CALENDAR_ID, body=event).execute()
+    if leg is not None:
+        # Lets the next refresh keep this event without planning the leg again, as long as its inputs are unchanged.
+        # Provisional routes don't get the fingerprint, so they are planned again until a real route replaces them
+        # (null removes the fingerprint of a patched event, patches merge the private properties)
+        event['extendedProperties'] = {'private': {'leg': leg.fingerprint if not route.provisional else None,
+                                                   'legKey': "|".join(leg.key)}}
     return event
 
 
+def leg_fingerprint(event) -> Optional[str]:
+    return event.get("extendedProperties", {}).get("private", {}).get("leg", None)
+
+
+def leg_key(event) -> Optional[tuple[str, str]]:
+    key = event.get("extendedProperties", {}).get("private", {}).get("legKey", None)
+    return tuple(key.split("|")) if key is not None else None
+
+
+def is_provisional(event) -> bool:
+    return leg_key(event) is not None and leg_fingerprint(event) is None
+
+
 def event_equals_route(event, route: Route) -> bool:
     # Check start and end-time
     start_time_check = datetime.fromisoformat(event["start"]["dateTime"]) == route.departure
@@ -305,8 +534,19 @@ def event_equals_route(event, route: Route) -> bool:
     return start_time_check and end_time_check and summary_check
 
 
-def refresh_day(day, known_events, known_home_override):
-    current_routes = get_events_from_calendar(settings.ROUTE_CALENDAR_ID, day)
+def day_fingerprint(legs: list[Leg]) -> str:
+    """ Only changes if a leg is added, removed or has to be planned differently (not e.g. on a changed title) """
+    return hashlib.sha256("".join(leg.fingerprint for leg in legs).encode()).hexdigest()
+
+
+def next_departure(route_events) -> Optional[datetime]:
+    departures = [datetime.fromisoformat(event["start"]["dateTime"]) for event in route_events]
+    return min((departure for departure in departures if departure > datetime.now(UTC)), default=None)
+
+
+def update_day(day, known_fingerprint: Optional[str]) -> DayRefresh:
+    route_calendar_id = current_profile().route_calendar_id
+    current_routes = get_events_from_calendar(route_calendar_id, day)
     events_today, home_override = get_events_on_day(day)
 
     upcoming_route = None
@@ -317,122 +557,183 @@ def refresh_day(day, known_events, known_home_override):
             upcoming_route = route
             break
 
-    if events_today == known_events and home_override == known_home_override and not upcoming_route:
-        return events_today, upcoming_route, home_override
-
-    target_routes = get_routes_for_events(events_today, home_override)
-
-    events_to_remove = [event for event in current_routes if
-                        not any(event_equals_route(event, route) for route in target_routes)]
-    routes_to_add = [route for route in target_routes if
-                     not any(event_equals_route(event, route) for event in current_routes)]
-
-    for event in events_to_remove:
-        CalendarClient().service.events().delete(calendarId=settings.ROUTE_CALENDAR_ID, eventId=event['id']).execute()
+    memo = EventMemo()
+    legs = plan_legs(events_today, home_override, memo)
+    fingerprint = day_fingerprint(legs)
+    # Always compared, even on days the sync didn't touch: a leg's routing API changes when its date comes within
+    # GTFS_OFFLINE_AFTER_DAYS
+    unchanged = fingerprint == known_fingerprint
+    # Provisional routes are replaced by real ones once they expire from the route cache, even on unchanged days
+    if unchanged and not upcoming_route and not any(is_provisional(event) for event in current_routes):
+        return DayRefresh(events_today, upcoming_route, home_override, next_departure=next_departure(current_routes),
+                          fingerprint=fingerprint)
+
+    # Legs whose inputs didn't change keep their event without being planned again, except for the upcoming route
+    # (e.g. because of delays)
+    leg_fingerprints = {leg.fingerprint for leg in legs}
+    kept_events = {}
+    for event in current_routes:
+        if leg_fingerprint(event) in leg_fingerprints and leg_fingerprint(event) not in kept_events and \
+                event is not upcoming_route:
+            kept_events[leg_fingerprint(event)] = event
+    kept_event_ids = {event["id"] for event in kept_events.values()}
+    replaced_routes = [event for event in current_routes if event["id"] not in kept_event_ids]
+
+    target_routes = [(leg, leg.route(memo)) for leg in legs if leg.fingerprint not in kept_events]
+    target_routes = [(leg, route) for leg, route in target_routes if route is not None]
+
+    # Events are matched to legs by the events they connect, a moved lecture only patches its legs' events in place.
+    # Events are only created or deleted for legs that appear or disappear
+    events_by_leg = {}
+    for event in replaced_routes:
+        if leg_key(event) is not None:
+            events_by_leg.setdefault(leg_key(event), event)
+    routes_to_patch = []
+    routes_to_add = []
+    matched_event_ids = set()
+    for leg, route in target_routes:
+        event = events_by_leg.pop(leg.key, None)
+        if event is None:
+            routes_to_add.append((leg, route))
+            continue
+        matched_event_ids.add(event["id"])
+        if leg_fingerprint(event) != (leg.fingerprint if not route.provisional else None) or \
+                not event_equals_route(event, route):
+            routes_to_patch.append((leg, route, event))
+    events_to_remove = [event for event in replaced_routes if event["id"] not in matched_event_ids]
+
+    calendar_events = CalendarClient().service.events()
+    with metrics.span("calendar_write"):
+        responses = execute_batch(
+            [calendar_events.delete(calendarId=route_calendar_id, eventId=event['id'])
+             for event in events_to_remove] +
+            [calendar_events.patch(calendarId=route_calendar_id, eventId=event['id'],
+                                   body=route_to_event(route, leg), sendUpdates="none")
+             for leg, route, event in routes_to_patch] +
+            [calendar_events.insert(calendarId=route_calendar_id, body=route_to_event(route, leg))
+             for leg, route in routes_to_add]
+        )
+    delete_responses = responses[:len(events_to_remove)]
+    patch_responses = responses[len(events_to_remove):len(events_to_remove) + len(routes_to_patch)]
+    insert_responses = responses[len(events_to_remove) + len(routes_to_patch):]
+    if settings.INCREMENTAL_SYNC:
+        CalendarSync().apply_writes(
+            route_calendar_id,
+            [route_event for route_event in patch_responses + insert_responses if route_event is not None],
+            [event["id"] for event, response in zip(events_to_remove, delete_responses) if response is not None])
+
+    for event, response in zip(events_to_remove, delete_responses):
+        if response is None:
+            continue
         print(f"[{day}] {TerminalStyles.HEADER}Removed event {event['id']}{TerminalStyles.ENDC}")
-    for route in routes_to_add:
-        route_event = add_route_to_calendar(route)
-        # Check for new upcoming route
-        if (datetime.fromisoformat(route_event["start"]["dateTime"]) > datetime.now(UTC) and
-           (datetime.fromisoformat(route_event["start"]["dateTime"]) - datetime.now(UTC)) < timedelta(minutes=30)):
-            upcoming_route = route_event
+    for (_, route, _), route_event in zip(routes_to_patch, patch_responses):
+        if route_event is None:
+            print(f"[{day}] {TerminalStyles.FAIL}Couldn't update event {route.calendar_summary}{TerminalStyles.ENDC}")
+            continue
+        print(f"[{day}] {TerminalStyles.OKCYAN}Updated event {route.calendar_summary}{TerminalStyles.ENDC}")
+    for (_, route), route_event in zip(routes_to_add, insert_responses):
+        if route_event is None:
+            print(f"[{day}] {TerminalStyles.FAIL}Couldn't create event {route.calendar_summary}{TerminalStyles.ENDC}")
+            continue
         print(f"[{day}] {TerminalStyles.OKGREEN}Created new event {route.calendar_summary}{TerminalStyles.ENDC}")
+    # Check for new upcoming route
+    for route_event in patch_responses + insert_responses:
+        if route_event is not None and \
+                datetime.fromisoformat(route_event["start"]["dateTime"]) > datetime.now(UTC) and \
+                datetime.fromisoformat(route_event["start"]["dateTime"]) - datetime.now(UTC) < timedelta(minutes=30):
+            upcoming_route = route_event
 
-    return events_today, upcoming_route, home_override
+    departures = [route.departure for _, route in target_routes] + \
+        [datetime.fromisoformat(event["start"]["dateTime"]) for event in kept_events.values()]
+    # Without a fingerprint the next refresh doesn't count the day as unchanged, so failed writes are retried
+    complete = all(response is not None for response in responses)
+    return DayRefresh(events_today, upcoming_route, home_override,
+                      changed_routes=len(events_to_remove) + len(routes_to_patch) + len(routes_to_add),
+                      next_departure=min((departure for departure in departures if departure > datetime.now(UTC)),
+                                         default=None),
+                      fingerprint=fingerprint if complete else None)
 
 
-def refresh_week(day_of_week: date, known_events, known_home_overrides):
-    new_events = {}
-    new_known_home_overrides = {}
-    monday = day_of_week - timedelta(days=day_of_week.weekday())
-    for day in range(0, 7):
-        current_day = monday + timedelta(days=day)
-        if current_day <= date.today():
-            print(f"[{current_day}] is in the past or today, skipping")
-            continue
-        print(f"[{current_day}] Refreshing...")
-        new_events[day], _, new_known_home_overrides[day] = refresh_day(
-            current_day, known_events[day], known_home_overrides[day])
+# The scheduler only decides when to refresh, the blocking network I/O runs in these pools. Today has its own pool,
+# so refreshes of far-future days can't delay the upcoming route updates.
+today_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="refresh-today")
+background_executor = ThreadPoolExecutor(max_workers=settings.BACKGROUND_WORKER_COUNT,
+                                         thread_name_prefix="refresh-background")
 
-    return new_events, new_known_home_overrides
 
+async def run_blocking(executor: ThreadPoolExecutor, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(func, *args))
 
-async def update_week_except_today_loop():
-    known_events: dict[int, list | None] = {i: None for i in range(7)}
-    known_home_overrides = {i: None for i in range(7)}
-    known_events_monday = date.today() - timedelta(days=date.today().weekday())
 
+async def push_channel_loop(push_notifications: PushNotifications):
+    await run_blocking(background_executor, push_notifications.watch_all)
     while 1:
-        print(f"[{known_events_monday}] {TerminalStyles.UNDERLINE}Starting Update All Loop{TerminalStyles.ENDC}")
-        if date.today() - timedelta(days=date.today().weekday()) != known_events_monday:
-            known_events = {i: None for i in range(7)}
-            known_home_overrides = {i: None for i in range(7)}
-            known_events_monday = date.today() - timedelta(days=date.today().weekday())
-
-        known_events, known_home_overrides = refresh_week(date.today(), known_events, known_home_overrides)
-        print(f"[{known_events_monday}] {TerminalStyles.OKGREEN}Finished Update All Loop{TerminalStyles.ENDC}")
-        await asyncio.sleep(10 * 60)
-
-
-async def update_following_weeks():
-    def get_default_known_events():
-        return {i: {j: None for j in range(7)} for i in range(settings.PRE_CALC_WEEK_COUNT)}
-
-    known_events = get_default_known_events()
-    known_home_overrides = {i: {j: None for j in range(7)} for i in range(settings.PRE_CALC_WEEK_COUNT)}
-    known_events_monday = date.today() - timedelta(days=date.today().weekday() - 7)
+        await asyncio.sleep(60 * 60)
+        await run_blocking(background_executor, push_notifications.renew_expiring_channels)
 
-    while 1:
-        print(
-            f"[{known_events_monday}] {
-                TerminalStyles.UNDERLINE}Starting Update Following Weeks Loop{TerminalStyles.ENDC}")
-        if date.today() - timedelta(days=date.today().weekday() - 7) != known_events_monday:
-            known_events = get_default_known_events()
-            known_home_overrides = {i: {j: None for j in range(7)} for i in range(settings.PRE_CALC_WEEK_COUNT)}
-            known_events_monday = date.today() - timedelta(days=date.today().weekday() - 7)
-
-        for week in range(settings.PRE_CALC_WEEK_COUNT):
-            date_today = date.today() + timedelta(days=7 * (week + 1))
-            known_events[week], known_home_overrides[week] = refresh_week(
-                date_today, known_events[week], known_home_overrides[week])
-        print(
-            f"[{known_events_monday}] {
-                TerminalStyles.OKGREEN}Finished Update Following Weeks Loop{TerminalStyles.ENDC}")
-        await asyncio.sleep(30 * 60)
-
-
-async def update_today_loop(upcoming_route_callback=lambda route: None):
-    known_events: None | list = None
-    known_home_override = None
-    known_events_day = date.today()
 
-    while 1:
-        print(f"[{known_events_day}] {TerminalStyles.UNDERLINE}Starting Update Today Loop{TerminalStyles.ENDC}")
-        if date.today() != known_events_day:
-            known_events = None
-            known_home_override = None
-            known_events_day = date.today()
-
-        known_events, upcoming_route, known_home_override = refresh_day(
-            date.today(), known_events, known_home_override)
-        print(f"[{known_events_day}] {TerminalStyles.OKGREEN}Finished Update Today Loop{TerminalStyles.ENDC}")
-        if upcoming_route:
-            print(
-                f"[{known_events_day}] {TerminalStyles.WARNING}Has upcoming route, 1min waiting times...{
-                    TerminalStyles.ENDC}")
-            upcoming_route_callback(upcoming_route)
-            await asyncio.sleep(1 * 60)
-        else:
-            print(f"[{known_events_day}] No upcoming route, 5min waiting time")
-            await asyncio.sleep(5 * 60)
+async def save_state(scheduler: RefreshScheduler):
+    # The snapshot is taken on the event loop, so the scheduler's states can't change while they are copied
+    days, routes = scheduler.snapshot(), route_cache.snapshot()
+    try:
+        await run_blocking(background_executor, save_snapshot, days, routes)
+    except OSError as ex:
+        print(f"Couldn't save the planner state: {ex}")
 
 
-async def main():
-    await asyncio.gather(
-        update_today_loop(),
-        update_week_except_today_loop(),
-        update_following_weeks()
+async def state_loop(scheduler: RefreshScheduler):
+    try:
+        while 1:
+            await asyncio.sleep(settings.PLANNER_STATE_SAVE_INTERVAL)
+            await save_state(scheduler)
+    finally:
+        await save_state(scheduler)
+
+
+def cache_stats() -> dict[str, dict]:
+    return {"route": route_cache.stats, "location": LocationCache().stats}
+
+
+metrics.collector("commute_planner_cache_hits_total", "counter",
+                  lambda: [({"cache": cache}, stats["hits"]) for cache, stats in cache_stats().items()])
+metrics.collector("commute_planner_cache_misses_total", "counter",
+                  lambda: [({"cache": cache}, stats["misses"]) for cache, stats in cache_stats().items()])
+metrics.collector("commute_planner_cache_hit_ratio", "gauge",
+                  lambda: [({"cache": cache}, stats["hit_rate"]) for cache, stats in cache_stats().items()])
+
+
+def create_scheduler(upcoming_route_callback=lambda route: None) -> RefreshScheduler:
+    if current_profile().home_pos is None:
+        raise ValueError("HOME_LATITUDE and HOME_LONGITUDE are required (or use the service mode with profiles)")
+    if settings.METRICS_ENDPOINT:
+        metrics.start_server()
+    scheduler = RefreshScheduler(
+        update_day, today_executor, day_executor,
+        sync=CalendarSync().sync_all if settings.INCREMENTAL_SYNC else None,
+        prefetch=None if settings.INCREMENTAL_SYNC else prefetch_days,
+        precompute=precompute_recurring_legs,
+        upcoming_route_callback=upcoming_route_callback
     )
+    # After a restart only days whose events changed in the meantime are planned again
+    snapshot = load_snapshot()
+    if snapshot:
+        scheduler.restore(snapshot["days"])
+        route_cache.restore(snapshot["routes"])
+    return scheduler
+
+
+async def main(upcoming_route_callback=lambda route: None):
+    scheduler = create_scheduler(upcoming_route_callback)
+    if not settings.PUSH_NOTIFICATIONS:
+        await asyncio.gather(scheduler.run(), state_loop(scheduler))
+        return
+
+    push_notifications = PushNotifications(lambda calendar_ids: scheduler.request_sync())
+    push_notifications.start()
+    try:
+        await asyncio.gather(scheduler.run(), state_loop(scheduler), push_channel_loop(push_notifications))
+    finally:
+        push_notifications.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,181 @@
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, UTC
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Literal
+
+from .profiles import current_profile
+from . import settings
+
+# Upper bounds in seconds, from cache hits up to slow Calendar batch requests
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels, le: str = None) -> str:
+    parts = [f"{key}=\"{_escape(value)}\"" for key, value in labels]
+    if le is not None:
+        parts.append(f"le=\"{le}\"")
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metrics:
+    """
+    Counters and latency histograms of the refresh pipeline, served in the Prometheus text format. Finished spans
+    are also written as JSON lines to METRICS_LOG_PATH
+    """
+
+    def __init__(self) -> None:
+        self._counters: dict[str, dict[tuple, float]] = {}
+        # name -> labels -> [count per bucket..., sum, count]
+        self._histograms: dict[str, dict[tuple, list]] = {}
+        self._collectors: dict[str, tuple[str, Callable[[], list[tuple[dict, float]]]]] = {}
+        self._help: dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self._log_file = None
+        self._server = None
+
+    def describe(self, name: str, help_text: str) -> None:
+        self._help[name] = help_text
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            histogram = self._histograms.setdefault(name, {})
+            buckets = histogram.setdefault(key, [0] * (len(LATENCY_BUCKETS) + 2))
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    buckets[i] += 1
+                    break
+            buckets[-2] += value
+            buckets[-1] += 1
+
+    def collector(self, name: str, type_: Literal["counter", "gauge"],
+                  collect: Callable[[], list[tuple[dict, float]]]) -> None:
+        """ Values that are already counted elsewhere (e.g. cache hits) are only read when the metrics are scraped """
+        self._collectors[name] = (type_, collect)
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        """ Times the block, labels have to have few distinct values (e.g. no days or event ids) """
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as ex:
+            error = type(ex).__name__
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe("commute_planner_span_seconds", seconds, span=name, **labels)
+            if error is not None:
+                self.increment("commute_planner_span_errors_total", span=name, error=error, **labels)
+            self.log("span", span=name, seconds=round(seconds, 6), error=error, **labels)
+
+    def timed(self, name: str):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def log(self, event: str, **fields) -> None:
+        if not settings.METRICS_LOG_PATH:
+            return
+        line = json.dumps({"time": datetime.now(UTC).isoformat(), "event": event, "profile": current_profile().name,
+                           **fields}, default=str)
+        with self._log_lock:
+            if self._log_file is None:
+                self._log_file = open(settings.METRICS_LOG_PATH, "a", encoding="utf-8", buffering=1)
+            self._log_file.write(line + "\n")
+
+    def render(self) -> str:
+        lines = []
+
+        def header(name: str, type_: str) -> None:
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {type_}")
+
+        with self._lock:
+            counters = {name: dict(values) for name, values in self._counters.items()}
+            histograms = {name: {key: list(buckets) for key, buckets in values.items()}
+                          for name, values in self._histograms.items()}
+
+        for name, values in sorted(counters.items()):
+            header(name, "counter")
+            lines.extend(f"{name}{_format_labels(key)} {value}" for key, value in sorted(values.items()))
+        for name, values in sorted(histograms.items()):
+            header(name, "histogram")
+            for key, buckets in sorted(values.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, buckets):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(key, str(bound))} {cumulative}")
+                lines.append(f"{name}_bucket{_format_labels(key, '+Inf')} {buckets[-1]}")
+                lines.append(f"{name}_sum{_format_labels(key)} {buckets[-2]}")
+                lines.append(f"{name}_count{_format_labels(key)} {buckets[-1]}")
+        for name, (type_, collect) in sorted(self._collectors.items()):
+            header(name, type_)
+            lines.extend(f"{name}{_format_labels(_label_key(labels))} {value}" for labels, value in collect())
+        return "\n".join(lines) + "\n"
+
+    def start_server(self) -> None:
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((settings.METRICS_LISTEN_HOST, settings.METRICS_LISTEN_PORT),
+                                           MetricsHandler)
+        threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True).start()
+        print(f"Serving metrics on http://{settings.METRICS_LISTEN_HOST}:{self._server.server_address[1]}/metrics")
+
+
+metrics = Metrics()
+metrics.describe("commute_planner_span_seconds", "Duration of the instrumented steps of a refresh")
+metrics.describe("commute_planner_span_errors_total", "Instrumented steps that raised an exception")
+metrics.describe("commute_planner_backend_request_seconds", "Duration of single requests per backend")
+metrics.describe("commute_planner_backend_wait_seconds", "Time spent waiting for a free request slot per backend")
+metrics.describe("commute_planner_backend_errors_total", "Failed requests per backend and reason")
+metrics.describe("commute_planner_backend_retries_total", "Retried requests per backend")
+metrics.describe("commute_planner_refresh_lag_seconds", "How late a day's refresh started compared to when it was due")
+metrics.describe("commute_planner_deadline_misses_total",
+                 "Refreshes of today that finished more than a minute after they were due")
+metrics.describe("commute_planner_cache_hits_total", "Lookups answered from a cache")
+metrics.describe("commute_planner_cache_misses_total", "Lookups a cache couldn't answer")
+metrics.describe("commute_planner_cache_hit_ratio", "Share of lookups answered from a cache since the start")
@@ -0,0 +1,41 @@
+import gzip
+import json
+import os
+import time
+
+from . import settings
+
+SNAPSHOT_VERSION = 2
+
+
+def save_snapshot(days: dict, routes: list, path: str = None) -> None:
+    """ Writes the planner state atomically, a crash while saving keeps the previous snapshot """
+    path = path or settings.PLANNER_STATE_PATH
+    data = gzip.compress(json.dumps({
+        "version": SNAPSHOT_VERSION,
+        "saved_at": time.time(),
+        "days": days,
+        "routes": routes
+    }, separators=(",", ":")).encode())
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(data)
+    os.replace(temporary_path, path)
+
+
+def load_snapshot(path: str = None) -> dict:
+    """ The saved planner state, empty if there is none (or it can't be read, e.g. after an incompatible update) """
+    path = path or settings.PLANNER_STATE_PATH
+    try:
+        with open(path, "rb") as file:
+            snapshot = json.loads(gzip.decompress(file.read()))
+    except FileNotFoundError:
+        return {}
+    except Exception as ex:
+        print(f"Couldn't load the planner state from {path}: {ex}")
+        return {}
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return {}
+    print(f"Loaded the planner state of {len(snapshot['days'])} days and {len(snapshot['routes'])} routes, saved {
+        (time.time() - snapshot['saved_at']) / 60:.0f} minutes ago")
+    return snapshot
@@ -0,0 +1,92 @@
+import functools
+import json
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Optional
+
+from . import settings
+
+
+@dataclass(frozen=True)
+class Profile:
+    """ The settings that differ between the users of one planner process, everything else is shared """
+    name: str
+    tum_calendar_id: str
+    main_calendar_id: str
+    route_calendar_id: str
+    home_pos: Optional[tuple[float, float]]
+    time_margin_before: float
+    time_margin_after: float
+    pre_calc_week_count: int
+    token_path: str = "token.json"
+
+    @classmethod
+    def from_settings(cls) -> "Profile":
+        return cls("default", settings.TUM_CALENDAR_ID, settings.MAIN_CALENDAR_ID, settings.ROUTE_CALENDAR_ID,
+                   settings.HOME_POS, settings.TIME_MARGIN_BEFORE, settings.TIME_MARGIN_AFTER,
+                   settings.PRE_CALC_WEEK_COUNT)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Profile":
+        """ Keys are named like the environment variables (lower case), missing optional ones fall back to them """
+        if "home_latitude" in data:
+            home_pos = float(data["home_latitude"]), float(data["home_longitude"])
+        else:
+            home_pos = settings.HOME_POS
+        if home_pos is None:
+            raise ValueError(f"Profile {data['name']} has no home location")
+        return cls(
+            name=data["name"],
+            tum_calendar_id=data["tum_calendar_id"],
+            main_calendar_id=data["main_calendar_id"],
+            route_calendar_id=data["route_calendar_id"],
+            home_pos=home_pos,
+            time_margin_before=float(data.get("time_margin_before_in_minutes", settings.TIME_MARGIN_BEFORE)),
+            time_margin_after=float(data.get("time_margin_after_in_minutes", settings.TIME_MARGIN_AFTER)),
+            pre_calc_week_count=int(data.get("pre_calc_week_count", settings.PRE_CALC_WEEK_COUNT)),
+            token_path=data.get("token_path", f"tokens/{data['name']}.json")
+        )
+
+    @property
+    def calendar_ids(self) -> tuple[str, str, str]:
+        return self.route_calendar_id, self.tum_calendar_id, self.main_calendar_id
+
+    def bind(self, func):
+        """ Runs func as this user, e.g. in another thread """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            token = _current_profile.set(self)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _current_profile.reset(token)
+
+        return wrapper
+
+
+_current_profile: ContextVar[Profile] = ContextVar("profile")
+
+
+@functools.cache
+def default_profile() -> Profile:
+    return Profile.from_settings()
+
+
+def current_profile() -> Profile:
+    """ The user the current task or thread plans for, the one configured in the environment by default """
+    profile = _current_profile.get(None)
+    return profile if profile is not None else default_profile()
+
+
+def use_profile(profile: Profile) -> None:
+    """ Switches the current context (e.g. a copied one a scheduler runs in) to the given user """
+    _current_profile.set(profile)
+
+
+def load_profiles(path: str = None) -> list[Profile]:
+    with open(path or settings.PROFILES_PATH, encoding="utf-8") as file:
+        profiles = [Profile.from_dict(data) for data in json.load(file)]
+    names = [profile.name for profile in profiles]
+    if len(set(names)) != len(names):
+        raise ValueError("Profile names have to be unique")
+    return profiles
@@ -0,0 +1,136 @@
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, UTC
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+import requests
+
+from .calendar_client import CalendarClient
+from .concurrency import backend_limit
+from .profiles import current_profile
+from . import settings
+
+
+class Debouncer:
+    """ Collects keys and calls the callback once no new key arrived for `delay` seconds (at most `max_delay`) """
+
+    def __init__(self, delay: float, max_delay: float, callback: Callable[[set], None]) -> None:
+        self.delay = delay
+        self.max_delay = max_delay
+        self.callback = callback
+        self._pending = set()
+        self._first_trigger = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def trigger(self, key) -> None:
+        with self._lock:
+            now = time.monotonic()
+            if not self._pending:
+                self._first_trigger = now
+            self._pending.add(key)
+            if self._timer is not None:
+                self._timer.cancel()
+            # A user editing several events in a row shouldn't postpone the refresh forever
+            delay = min(self.delay, max(0.0, self._first_trigger + self.max_delay - now))
+            self._timer = threading.Timer(delay, self._fire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _fire(self) -> None:
+        with self._lock:
+            pending = self._pending
+            self._pending = set()
+            self._timer = None
+        if pending:
+            self.callback(pending)
+
+
+class PushNotifications:
+    """ Registers Calendar watch channels and receives their notifications on a local webhook """
+
+    def __init__(self, on_change: Callable[[set[str]], None]) -> None:
+        # channel id -> (calendar id, resource id, expiration)
+        self.channels: dict[str, tuple[str, str, datetime]] = {}
+        self.debouncer = Debouncer(settings.PUSH_DEBOUNCE, settings.PUSH_MAX_DEBOUNCE, on_change)
+        self._server = None
+
+    def start(self) -> None:
+        self._server = ThreadingHTTPServer((settings.PUSH_LISTEN_HOST, settings.PUSH_LISTEN_PORT),
+                                           self._create_handler())
+        threading.Thread(target=self._server.serve_forever, name="push-notifications", daemon=True).start()
+        print(f"Listening for calendar push notifications on {
+            settings.PUSH_LISTEN_HOST}:{self._server.server_address[1]}")
+
+    def stop(self) -> None:
+        for channel_id in list(self.channels):
+            self.stop_channel(channel_id)
+        if self._server is not None:
+            self._server.shutdown()
+
+    def handle_notification(self, channel_id: str, token: str, resource_state: str) -> bool:
+        if token != settings.PUSH_CHANNEL_TOKEN or channel_id not in self.channels:
+            return False
+        # "sync" is only sent once when the channel is created
+        if resource_state != "sync":
+            self.debouncer.trigger(self.channels[channel_id][0])
+        return True
+
+    def _create_handler(self):
+        push_notifications = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                accepted = push_notifications.handle_notification(
+                    self.headers.get("X-Goog-Channel-ID", ""),
+                    self.headers.get("X-Goog-Channel-Token", ""),
+                    self.headers.get("X-Goog-Resource-State", "")
+                )
+                self.send_response(200 if accepted else 404)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return WebhookHandler
+
+    def watch(self, calendar_id: str) -> None:
+        channel_id = str(uuid.uuid4())
+        with backend_limit("GOOGLE"):
+            channel = CalendarClient().service.events().watch(calendarId=calendar_id, body={
+                "id": channel_id,
+                "type": "web_hook",
+                "address": settings.PUSH_WEBHOOK_URL,
+                "token": settings.PUSH_CHANNEL_TOKEN
+            }).execute()
+        expiration = datetime.fromtimestamp(int(channel["expiration"]) / 1000, UTC)
+        self.channels[channel_id] = (calendar_id, channel["resourceId"], expiration)
+
+    def watch_all(self) -> None:
+        for calendar_id in current_profile().calendar_ids:
+            self.watch(calendar_id)
+
+    def stop_channel(self, channel_id: str) -> None:
+        _, resource_id, _ = self.channels.pop(channel_id)
+        with backend_limit("GOOGLE"):
+            CalendarClient().service.channels().stop(body={"id": channel_id, "resourceId": resource_id}).execute()
+
+    def renew_expiring_channels(self) -> None:
+        """ Channels expire after some days, they are replaced a day before that """
+        for channel_id, (calendar_id, _, expiration) in list(self.channels.items()):
+            if expiration - datetime.now(UTC) < timedelta(days=1):
+                self.watch(calendar_id)
+                self.stop_channel(channel_id)
+
+
+def send_test_notification(url: str, channel_id: str, token: str = None, resource_state: str = "exists"):
+    """ Posts a notification like Google does, e.g. to test the webhook receiver locally """
+    return requests.post(url, headers={
+        "X-Goog-Channel-ID": channel_id,
+        "X-Goog-Channel-Token": token if token is not None else settings.PUSH_CHANNEL_TOKEN,
+        "X-Goog-Resource-State": resource_state,
+        "X-Goog-Resource-ID": "test",
+        "X-Goog-Message-Number": "1"
+    }, timeout=settings.HTTP_TIMEOUT)
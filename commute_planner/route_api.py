@@ -1,13 +1,25 @@
 import asyncio
-from typing import Optional, Literal
-from datetime import datetime, timedelta
+import functools
+import heapq
+import threading
+import time as time_module
+import weakref
+from typing import Callable, Optional, Literal
+from datetime import datetime, timedelta, timezone
 import requests
-from dataclasses import dataclass
+from dataclasses import asdict, dataclass, replace
 
 from pytz import utc
-from geopy import distance
 
+from .budget import current_priority, prioritized
 from .calendar_client import bold, italic
+from .concurrency import search_executor
+from .metrics import metrics
+from . import spatial
+from .spatial import fast_distance, within_distance
+from .single_flight import SingleFlight
+from .transport import request_json
+from .travel_matrix import TravelMatrix
 
 from . import settings
 
@@ -29,12 +41,42 @@ MOVEMENT_TYPES = {
 }
 
 
-@dataclass
+# Stations and lines repeat across routes and days, so each one only exists once (as long as it's used anywhere)
+_interned = weakref.WeakValueDictionary()
+_interned_lock = threading.Lock()
+
+
+def intern(cls, *fields):
+    key = (cls, *fields)
+    with _interned_lock:
+        instance = _interned.get(key)
+        if instance is None:
+            instance = _interned[key] = cls(*fields)
+        return instance
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_time(value: str) -> tuple[int, int]:
+    """ Timestamp and UTC offset (in seconds) of an ISO time, the same times show up in many candidates and windows """
+    time = datetime.fromisoformat(value)
+    return int(time.timestamp()), int(time.utcoffset().total_seconds())
+
+
+@functools.lru_cache(maxsize=None)
+def fixed_timezone(utc_offset: int) -> timezone:
+    return timezone(timedelta(seconds=utc_offset)) if utc_offset else timezone.utc
+
+
+@dataclass(frozen=True, slots=True, weakref_slot=True)
 class Location:
     name: str
     place: str
     coordinates: tuple
 
+    @classmethod
+    def create(cls, name: str, place: str, coordinates: Optional[tuple]) -> "Location":
+        return intern(cls, name, place, tuple(coordinates) if coordinates is not None else None)
+
     @classmethod
     def coords_from_part(cls, part, type_: Literal["FROM", "TO"]):
         index = 0 if type_ == "FROM" else -1
@@ -62,12 +104,16 @@ class Location:
         return str(self.name) + f", {self.place}" if self.place else ""
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, weakref_slot=True)
 class MovementType:
     movement_type: str
     name: str
     destination: str
 
+    @classmethod
+    def create(cls, movement_type: str, name: str, destination: str) -> "MovementType":
+        return intern(cls, movement_type, name, destination)
+
     @property
     def symbol(self) -> str:
         return MOVEMENT_TYPES.get(self.movement_type, self.movement_type)
@@ -76,14 +122,30 @@ class MovementType:
         return f"{self.symbol} {self.name}{f' ({self.destination})' if self.destination else ''}"
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class RoutePart:
-    departure: datetime
-    arrival: datetime
+    departure_timestamp: int
+    arrival_timestamp: int
+    # Offset to UTC in seconds, so the times are shown in the time zone the API returned them in
+    utc_offset: int
     start: Location
     end: Location
     movement_type: MovementType
 
+    @classmethod
+    def create(cls, departure: datetime, arrival: datetime, start: Location, end: Location,
+               movement_type: MovementType) -> "RoutePart":
+        return cls(int(departure.timestamp()), int(arrival.timestamp()),
+                   int(departure.utcoffset().total_seconds()), start, end, movement_type)
+
+    @property
+    def departure(self) -> datetime:
+        return datetime.fromtimestamp(self.departure_timestamp, fixed_timezone(self.utc_offset))
+
+    @property
+    def arrival(self) -> datetime:
+        return datetime.fromtimestamp(self.arrival_timestamp, fixed_timezone(self.utc_offset))
+
     def __str__(self) -> str:
         return f"{self.departure.strftime('%H:%M')} - {self.arrival.strftime('%H:%M')} {self.movement_type} ➜ {self.end.name}"
 
@@ -92,68 +154,123 @@ class RoutePart:
         return f"{self.departure.strftime('%H:%M')} {bold(str(self.movement_type))} ➜ {self.end.name}"
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
+class RouteCandidate:
+    """ A route of which only departure and arrival are parsed yet, the rest is only parsed if it gets chosen """
+    departure_timestamp: int
+    arrival_timestamp: int
+    data: dict
+    parse: Callable[[dict], "Route"]
+
+    @classmethod
+    def from_mvg_data(cls, route_data: dict) -> "RouteCandidate":
+        first_part, last_part = route_data["parts"][0], route_data["parts"][-1]
+        return cls(
+            parse_time(first_part["from"]["plannedDeparture"])[0],
+            parse_time(last_part["to"]["plannedDeparture"])[0] +
+            int(last_part["to"].get("arrivalDelayInMinutes", 0)) * 60,
+            route_data, Route.from_mvg_data
+        )
+
+    @classmethod
+    def from_db_data(cls, route_data: dict) -> "RouteCandidate":
+        first_part, last_part = route_data["verbindungsAbschnitte"][0], route_data["verbindungsAbschnitte"][-1]
+        return cls(
+            parse_time(first_part.get("ezAbfahrtsZeitpunkt", first_part["abfahrtsZeitpunkt"]))[0],
+            parse_time(last_part.get("ezAnkunftsZeitpunkt", last_part["ankunftsZeitpunkt"]))[0],
+            route_data, Route.from_db_data
+        )
+
+    def materialize(self) -> "Route":
+        return self.parse(self.data)
+
+
+@dataclass(frozen=True, slots=True)
 class Route:
-    parts: list
+    parts: tuple[RoutePart, ...]
+    # Not queried for this trip itself (e.g. copied from another week), so it's queried once it's close enough
+    provisional: bool = False
 
     @classmethod
     def from_mvg_data(cls, route_data: dict):
-        self = cls([])
-
+        parts = []
         for part in route_data["parts"]:
-            self.parts.append(
-                RoutePart(
-                    datetime.fromisoformat(part["from"]["plannedDeparture"]),
-                    (datetime.fromisoformat(part["to"]["plannedDeparture"]) + timedelta(
-                        minutes=int(part["to"].get("arrivalDelayInMinutes", 0)))),
-                    Location(
-                        part["from"]["name"],
-                        part["from"]["place"],
-                        (part["from"]["latitude"], part["from"]["longitude"])
-                    ),
-                    Location(
-                        part["to"]["name"],
-                        part["to"]["place"],
-                        (part["to"]["latitude"], part["to"]["longitude"])
-                    ),
-                    MovementType(
-                        part["line"]["transportType"],
-                        part["line"]["label"],
-                        part["line"]["destination"]
-                    )
+            departure, utc_offset = parse_time(part["from"]["plannedDeparture"])
+            parts.append(RoutePart(
+                departure,
+                parse_time(part["to"]["plannedDeparture"])[0] + int(part["to"].get("arrivalDelayInMinutes", 0)) * 60,
+                utc_offset,
+                Location.create(
+                    part["from"]["name"],
+                    part["from"]["place"],
+                    (part["from"]["latitude"], part["from"]["longitude"])
+                ),
+                Location.create(
+                    part["to"]["name"],
+                    part["to"]["place"],
+                    (part["to"]["latitude"], part["to"]["longitude"])
+                ),
+                MovementType.create(
+                    part["line"]["transportType"],
+                    part["line"]["label"],
+                    part["line"]["destination"]
                 )
-            )
-
-        return self
+            ))
+        return cls(tuple(parts))
 
     @classmethod
     def from_db_data(cls, route_data: dict):
-        self = cls([])
-
+        parts = []
         for part in route_data["verbindungsAbschnitte"]:
-            self.parts.append(
-                RoutePart(
-                    datetime.fromisoformat(part.get("ezAbfahrtsZeitpunkt", part["abfahrtsZeitpunkt"])),
-                    datetime.fromisoformat(part.get("ezAnkunftsZeitpunkt", part["ankunftsZeitpunkt"])),
-                    Location(
-                        part["abfahrtsOrt"],
-                        "",
-                        Location.coords_from_part(part, type_="FROM")
-                    ),
-                    Location(
-                        part["ankunftsOrt"],
-                        "",
-                        Location.coords_from_part(part, type_="TO")
-                    ),
-                    MovementType(
-                        "PEDESTRIAN" if part["verkehrsmittel"].get("typ", "") == "WALK"
-                        else part["verkehrsmittel"].get("produktGattung", "UNKNOWN"),
-                        part["verkehrsmittel"].get("langText", part["verkehrsmittel"]["name"]),
-                        part["verkehrsmittel"].get("richtung", "")
-                    )
+            departure, utc_offset = parse_time(part.get("ezAbfahrtsZeitpunkt", part["abfahrtsZeitpunkt"]))
+            parts.append(RoutePart(
+                departure,
+                parse_time(part.get("ezAnkunftsZeitpunkt", part["ankunftsZeitpunkt"]))[0],
+                utc_offset,
+                Location.create(
+                    part["abfahrtsOrt"],
+                    "",
+                    Location.coords_from_part(part, type_="FROM")
+                ),
+                Location.create(
+                    part["ankunftsOrt"],
+                    "",
+                    Location.coords_from_part(part, type_="TO")
+                ),
+                MovementType.create(
+                    "PEDESTRIAN" if part["verkehrsmittel"].get("typ", "") == "WALK"
+                    else part["verkehrsmittel"].get("produktGattung", "UNKNOWN"),
+                    part["verkehrsmittel"].get("langText", part["verkehrsmittel"]["name"]),
+                    part["verkehrsmittel"].get("richtung", "")
                 )
-            )
+            ))
+        return cls(tuple(parts))
+
+    def shifted(self, seconds: int, utc_offset_change: int = 0) -> "Route":
+        """ The same connection some days later, e.g. for a weekly recurring lecture """
+        # Only times in local time (non-UTC offsets) follow daylight saving time
+        return Route(tuple(
+            RoutePart(part.departure_timestamp + seconds, part.arrival_timestamp + seconds,
+                      part.utc_offset + utc_offset_change if part.utc_offset else 0,
+                      part.start, part.end, part.movement_type)
+            for part in self.parts
+        ), provisional=True)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
 
+    @classmethod
+    def from_dict(cls, data: dict) -> "Route":
+        # Restored (e.g. from the planner state) stations and lines are shared as well
+        return cls(tuple(
+            RoutePart(part["departure_timestamp"], part["arrival_timestamp"], part["utc_offset"],
+                      Location.create(**part["start"]), Location.create(**part["end"]),
+                      MovementType.create(**part["movement_type"]))
+            for part in data["parts"]
+        ), data["provisional"])
+
+    def materialize(self) -> "Route":
+        # Already fully parsed (e.g. from the GTFS feed)
         return self
 
     def __str__(self) -> str:
@@ -174,6 +291,14 @@ class Route:
         ]
         return ' ➜ '.join(movements)
 
+    @property
+    def departure_timestamp(self) -> int:
+        return self.parts[0].departure_timestamp
+
+    @property
+    def arrival_timestamp(self) -> int:
+        return self.parts[-1].arrival_timestamp
+
     @property
     def departure(self) -> datetime:
         return self.parts[0].departure
@@ -196,107 +321,276 @@ class Route:
 
 
 def get_route_from_db(origin, destination, arrival_time, type_: Literal["ARRIVAL", "DEPARTURE"]):
-    response = requests.post("https://www.bahn.de/web/api/angebote/fahrplan", json={
-        "abfahrtsHalt": f"@X={
-            str(origin[1]).replace('.', '')[:8].ljust(8, '0')
-        }@Y={
-            str(origin[0]).replace('.', '')[:8].ljust(8, '0')
-        }",
-        "anfrageZeitpunkt": arrival_time.isoformat(),
-        "ankunftsHalt": f"@X={str(destination[1]).replace('.', '')[:8].ljust(8, '0')}@Y={str(destination[0]).replace('.', '')[:8].ljust(8, '0')}",
-        "ankunftSuche": "ABFAHRT" if type_ == "DEPARTURE" else "ANKUNFT",
-        "klasse": "KLASSE_2",
-        "produktgattungen": [
-            "ICE",
-            "EC_IC",
-            "IR",
-            "REGIONAL",
-            "SBAHN",
-            "BUS",
-            "SCHIFF",
-            "UBAHN",
-            "TRAM",
-            "ANRUFPFLICHTIG"
-        ],
-        "reisende": [
-            {
-                "typ": "ERWACHSENER",
-                "ermaessigungen": [
-                    {
-                        "art": "KEINE_ERMAESSIGUNG",
-                        "klasse": "KLASSENLOS"
-                    }
-                ],
-                "alter": [],
-                "anzahl": 1
-            }
-        ],
-        "rueckfahrtAnfrageFolgt": False,
-        "schnelleVerbindungen": True,
-        "sitzplatzOnly": False,
-        "bikeCarriage": False,
-        "reservierungsKontingenteVorhanden": False
-    }, headers={"User-Agent": settings.USER_AGENT})
     try:
-        response_json = response.json()
-    except Exception as ex:
-        print(ex)
-        print(response.status_code, response.headers, response.content)
-        return get_route_from_db(origin, destination, arrival_time, type_)
-        # raise Exception("Invalid DB API Response") from ex
-
-    return [Route.from_db_data(route) for route in response_json.get("verbindungen", [])]
+        response_json = request_json("POST", "https://www.bahn.de/web/api/angebote/fahrplan", "DB", json={
+            "abfahrtsHalt": f"@X={
+                str(origin[1]).replace('.', '')[:8].ljust(8, '0')
+            }@Y={
+                str(origin[0]).replace('.', '')[:8].ljust(8, '0')
+            }",
+            "anfrageZeitpunkt": arrival_time.isoformat(),
+            "ankunftsHalt": f"@X={str(destination[1]).replace('.', '')[:8].ljust(8, '0')}@Y={str(destination[0]).replace('.', '')[:8].ljust(8, '0')}",
+            "ankunftSuche": "ABFAHRT" if type_ == "DEPARTURE" else "ANKUNFT",
+            "klasse": "KLASSE_2",
+            "produktgattungen": [
+                "ICE",
+                "EC_IC",
+                "IR",
+                "REGIONAL",
+                "SBAHN",
+                "BUS",
+                "SCHIFF",
+                "UBAHN",
+                "TRAM",
+                "ANRUFPFLICHTIG"
+            ],
+            "reisende": [
+                {
+                    "typ": "ERWACHSENER",
+                    "ermaessigungen": [
+                        {
+                            "art": "KEINE_ERMAESSIGUNG",
+                            "klasse": "KLASSENLOS"
+                        }
+                    ],
+                    "alter": [],
+                    "anzahl": 1
+                }
+            ],
+            "rueckfahrtAnfrageFolgt": False,
+            "schnelleVerbindungen": True,
+            "sitzplatzOnly": False,
+            "bikeCarriage": False,
+            "reservierungsKontingenteVorhanden": False
+        })
+    except (requests.RequestException, ValueError) as ex:
+        print(f"Invalid DB API Response: {ex}")
+        # Not the same as "no connection", which would remove the leg's event and be cached
+        raise
+
+    return [RouteCandidate.from_db_data(route) for route in response_json.get("verbindungen", [])]
 
 
 def get_route_from_mvg(origin, destination, arrival_time, type_: Literal["ARRIVAL", "DEPARTURE"]):
-    response = requests.get("https://www.mvg.de/api/fib/v2/connection", params={
-        "originLatitude": origin[0],
-        "originLongitude": origin[1],
-        "destinationLatitude": destination[0],
-        "destinationLongitude": destination[1],
-        "routingDateTime": arrival_time.replace(tzinfo=None).isoformat() + "Z",
-        "routingDateTimeIsArrival": type_ == "ARRIVAL",
-        "transportTypes": "SCHIFF,RUFTAXI,BAHN,UBAHN,TRAM,SBAHN,BUS,REGIONAL_BUS"
-    }, headers={"User-Agent": settings.USER_AGENT})
     try:
-        response_json = response.json()
-    except Exception as ex:
-        print(ex)
-        print(response.status_code, response.headers, response.content)
-        return get_route_from_mvg(origin, destination, arrival_time, type_)
-        # raise Exception("Invalid MVG API Response") from ex
+        response_json = request_json("GET", "https://www.mvg.de/api/fib/v2/connection", "MVG", params={
+            "originLatitude": origin[0],
+            "originLongitude": origin[1],
+            "destinationLatitude": destination[0],
+            "destinationLongitude": destination[1],
+            "routingDateTime": arrival_time.replace(tzinfo=None).isoformat() + "Z",
+            "routingDateTimeIsArrival": type_ == "ARRIVAL",
+            "transportTypes": "SCHIFF,RUFTAXI,BAHN,UBAHN,TRAM,SBAHN,BUS,REGIONAL_BUS"
+        })
+    except (requests.RequestException, ValueError) as ex:
+        print(f"Invalid MVG API Response: {ex}")
+        raise
+
+    return [RouteCandidate.from_mvg_data(route) for route in response_json]
+
+
+def get_route_from_gtfs(origin, destination, arrival_time, type_: Literal["ARRIVAL", "DEPARTURE"]):
+    # Imported here, as the feed is optional and only loaded when it's actually used
+    from .gtfs import GtfsFeed
 
-    return [Route.from_mvg_data(route) for route in response_json]
+    route = GtfsFeed().route(origin, destination, arrival_time, type_)
+    return [route] if route is not None else []
 
 
-def get_routes(origin, destination, arrival_time, type_: Literal["ARRIVAL", "DEPARTURE"], api_: Literal["MVG", "DB"]):
+def get_routes(origin, destination, arrival_time, type_: Literal["ARRIVAL", "DEPARTURE"],
+               api_: Literal["MVG", "DB", "GTFS"]):
     if api_ == "DB":
         return get_route_from_db(origin, destination, arrival_time, type_)
     elif api_ == "MVG":
         return get_route_from_mvg(origin, destination, arrival_time, type_)
+    elif api_ == "GTFS" and settings.GTFS_FEED_PATH:
+        return get_route_from_gtfs(origin, destination, arrival_time, type_)
 
     return []
 
 
-def get_best_route(routes: list[Route], time: datetime, type_: Literal["ARRIVAL", "DEPARTURE"]) -> Route:
+def get_best_route(routes: list[RouteCandidate | Route], time: datetime,
+                   type_: Literal["ARRIVAL", "DEPARTURE"]) -> Optional[RouteCandidate | Route]:
+    timestamp = time.replace(tzinfo=utc).timestamp()
     if type_ == "ARRIVAL":
-        filtered_routes = filter(lambda route: route.arrival <= time.replace(tzinfo=utc), routes)
-        return max(filtered_routes, key=lambda route: route.departure, default=None)
+        filtered_routes = filter(lambda route: route.arrival_timestamp <= timestamp, routes)
+        return max(filtered_routes, key=lambda route: route.departure_timestamp, default=None)
+
+    filtered_routes = filter(lambda route: route.departure_timestamp >= timestamp, routes)
+    return min(filtered_routes, key=lambda route: route.arrival_timestamp, default=None)
+
+
+class RouteCache:
+    """ In-memory cache for route queries, far-future routes are kept longer than near-term ones """
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self._routes: dict[tuple, tuple[float, Optional[Route]]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(origin, destination, time: datetime, type_: str, api_: str) -> tuple:
+        # Nearby locations (e.g. rooms of the same building) share their cache entries
+        origin, destination = spatial.locations.snap(origin), spatial.locations.snap(destination)
+        return (round(origin[0], settings.ROUTE_CACHE_COORDINATE_PRECISION),
+                round(origin[1], settings.ROUTE_CACHE_COORDINATE_PRECISION),
+                round(destination[0], settings.ROUTE_CACHE_COORDINATE_PRECISION),
+                round(destination[1], settings.ROUTE_CACHE_COORDINATE_PRECISION),
+                time.replace(tzinfo=utc).isoformat(), type_, api_)
+
+    @staticmethod
+    def ttl(time: datetime, route: Optional[Route] = None) -> float:
+        # Timetables rarely change for far-future dates, but delays matter close to the departure. That's the route's
+        # own departure if it's earlier, e.g. an arrival leg's route leaves well before the target time
+        timestamp = time.replace(tzinfo=utc).timestamp()
+        if route is not None:
+            timestamp = min(timestamp, route.departure_timestamp)
+        time_until = timestamp - datetime.now(utc).timestamp()
+        if time_until < settings.ROUTE_CACHE_MIN_LEAD_TIME:
+            return 0
+        return min(time_until * settings.ROUTE_CACHE_TTL_FACTOR, settings.ROUTE_CACHE_MAX_TTL)
+
+    def get(self, key: tuple) -> tuple[bool, Optional[Route]]:
+        with self._lock:
+            expires_at, route = self._routes.get(key, (0, None))
+            if expires_at < time_module.monotonic():
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            return True, route
+
+    def set(self, key: tuple, route: Optional[Route], ttl: float) -> None:
+        if ttl <= 0:
+            return
+        with self._lock:
+            now = time_module.monotonic()
+            if len(self._routes) >= settings.ROUTE_CACHE_SIZE:
+                self._routes = {k: v for k, v in self._routes.items() if v[0] >= now}
+            if len(self._routes) >= settings.ROUTE_CACHE_SIZE:
+                # Still full, the routes that expire soonest are dropped (a tenth at once, so it doesn't happen on
+                # every insert)
+                self._routes = dict(heapq.nlargest(settings.ROUTE_CACHE_SIZE * 9 // 10, self._routes.items(),
+                                                   key=lambda item: item[1][0]))
+            self._routes[key] = (now + ttl, route)
+
+    def snapshot(self) -> list[dict]:
+        """ Entries that are still valid (as JSON), with their expiry as wall clock time """
+        with self._lock:
+            now, wall_now = time_module.monotonic(), time_module.time()
+            entries = [(key, wall_now + expires_at - now, route)
+                       for key, (expires_at, route) in self._routes.items() if expires_at >= now]
+        return [{"key": list(key), "expires_at": expires_at, "route": route.to_dict() if route is not None else None}
+                for key, expires_at, route in entries]
+
+    def restore(self, entries: list[dict]) -> None:
+        now, wall_now = time_module.monotonic(), time_module.time()
+        routes = {}
+        skipped = 0
+        for entry in entries:
+            try:
+                if entry["expires_at"] > wall_now:
+                    route = Route.from_dict(entry["route"]) if entry["route"] is not None else None
+                    routes[tuple(entry["key"])] = (now + entry["expires_at"] - wall_now, route)
+            except (KeyError, TypeError, ValueError):
+                # E.g. saved by a version with different route fields, the route is simply queried again
+                skipped += 1
+        if skipped:
+            print(f"Skipped {skipped} saved routes that couldn't be restored")
+        with self._lock:
+            self._routes.update(routes)
+
+    @property
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._routes),
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
 
-    filtered_routes = filter(lambda route: route.departure >= time.replace(tzinfo=utc), routes)
-    return min(filtered_routes, key=lambda route: route.arrival, default=None)
+route_cache = RouteCache()
+route_flight = SingleFlight()
 
 
+@metrics.timed("get_route")
 def get_route(origin, destination, time, type_: Literal["ARRIVAL", "DEPARTURE"] = "ARRIVAL",
-              api_: Literal["MVG", "DB"] = "mvg", _try=0) -> Optional[Route]:
-    if distance.distance(origin, destination).kilometers <= settings.MIN_ROUTE_DISTANCE:
+              api_: Literal["MVG", "DB", "GTFS"] = "mvg") -> Optional[Route]:
+    if within_distance(origin, destination, settings.MIN_ROUTE_DISTANCE):
         print(f"[{time.strftime('%Y-%m-%d')}] Ignoring because too close to origin (distance of {
-            distance.distance(origin, destination).kilometers}km)")
+            fast_distance(origin, destination):.3f}km)")
+        return None
+
+    key = RouteCache.key(origin, destination, time, type_, api_)
+    # Loops asking for the same route at the same time share one query
+    return route_flight.do(key, _get_cached_route, key, origin, destination, time, type_, api_)
+
+
+def _get_cached_route(key: tuple, origin, destination, time, type_: Literal["ARRIVAL", "DEPARTURE"],
+                      api_: Literal["MVG", "DB", "GTFS"]) -> Optional[Route]:
+    found, route = route_cache.get(key)
+    if found:
+        return route
+
+    try:
+        route = find_route(origin, destination, time, type_, api_)
+    except (requests.RequestException, ValueError) as ex:
+        if api_ == "GTFS" or not settings.GTFS_FEED_PATH:
+            raise
+        # The live API is down, the offline timetable's route isn't cached (and provisional), so the API is asked again
+        print(f"[{time.strftime('%Y-%m-%d')}] {api_} failed ({ex}), falling back to the GTFS timetable")
+        route = get_best_route(get_routes(origin, destination, time, type_, "GTFS"), time, type_)
+        if route is None:
+            raise
+        return replace(route.materialize(), provisional=True)
+    route_cache.set(key, route, RouteCache.ttl(time, route))
+    if route is not None:
+        TravelMatrix().record(origin, destination, route.departure, route.duration)
+    return route
+
+
+def find_route(origin, destination, time, type_: Literal["ARRIVAL", "DEPARTURE"],
+               api_: Literal["MVG", "DB", "GTFS"]) -> Optional[Route]:
+    candidates = get_routes(origin, destination, time, type_, api_)
+    best_route = get_best_route(candidates, time, type_)
+    if best_route is None and api_ != "GTFS":
+        # Instead of retrying 30 mins earlier/later one after another, the remaining windows are queried at once and
+        # the best route is picked from all candidates. The GTFS router already returns the best journey
+        best_route = get_best_route(candidates + search_windows(origin, destination, time, type_, api_), time, type_)
+    if best_route is None and api_ != "GTFS" and settings.GTFS_FEED_PATH:
+        # The live API doesn't know the connection, fall back to the offline timetable
+        print(f"[{time.strftime('%Y-%m-%d')}] No route from {api_}, falling back to the GTFS timetable")
+        best_route = get_best_route(get_routes(origin, destination, time, type_, "GTFS"), time, type_)
+    if best_route is None and api_ == "GTFS":
+        # The feed doesn't cover the trip (e.g. no stop within walking distance of home or a gap in the feed)
+        print(f"[{time.strftime('%Y-%m-%d')}] No route in the GTFS timetable, asking MVG")
+        return find_route(origin, destination, time, type_, "MVG")
+    if best_route is None:
+        print(f"[{time.strftime('%Y-%m-%d')}] No route could be found within {
+            settings.ROUTE_SEARCH_WINDOWS * settings.ROUTE_SEARCH_WINDOW_OFFSET:.0f}mins")
         return None
-    best_route = get_best_route(get_routes(origin, destination, time, type_, api_), time, type_)
-    if best_route is None and _try < 3:  # If no route could be found, check 30 min earlier/later (max of 5 tries)
-        print(f"[{time.strftime('%Y-%m-%d')}] No route could be found, checking 30mins offset")
-        if type_ == "ARRIVAL":
-            return get_route(origin, destination, time - timedelta(minutes=30), type_, api_, _try+1)
-        return get_route(origin, destination, time + timedelta(minutes=30), type_, api_, _try+1)
-    return best_route
+    return best_route.materialize()
+
+
+def search_windows(origin, destination, time, type_: Literal["ARRIVAL", "DEPARTURE"],
+                   api_: Literal["MVG", "DB"]) -> list[RouteCandidate]:
+    """ Candidates of the windows after the first one, raises if none could be queried """
+    offset = timedelta(minutes=settings.ROUTE_SEARCH_WINDOW_OFFSET)
+    window_times = [time - offset * i if type_ == "ARRIVAL" else time + offset * i
+                    for i in range(1, settings.ROUTE_SEARCH_WINDOWS)]
+    # The windows are sent with the priority of the refresh that needs them
+    search = prioritized(current_priority(), get_routes)
+    futures = [search_executor.submit(search, origin, destination, window_time, type_, api_)
+               for window_time in window_times]
+    candidates = []
+    errors = []
+    for future in futures:
+        try:
+            candidates.extend(future.result())
+        except (requests.RequestException, ValueError) as ex:
+            errors.append(ex)
+    if errors and not candidates:
+        raise errors[0]
+    return candidates
@@ -0,0 +1,319 @@
+import asyncio
+import contextvars
+import functools
+import heapq
+import time
+from collections import deque
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from datetime import datetime, date, timedelta, UTC
+from typing import Callable, Optional
+
+from .budget import prioritized, priority_for_day, PRIORITY_PRECOMPUTE, PRIORITY_TODAY, PRIORITY_UPCOMING
+from .metrics import metrics
+from .profiles import current_profile
+from . import settings
+
+
+@dataclass
+class DayRefresh:
+    """ Result of refreshing a single day """
+    events: list
+    upcoming_route: Optional[dict]
+    home_override: dict
+    changed_routes: int = 0
+    next_departure: Optional[datetime] = None
+    # Hash of everything the day's routes are planned from, unchanged days don't have to be planned again
+    fingerprint: Optional[str] = None
+
+
+@dataclass
+class DayState:
+    fingerprint: Optional[str] = None
+    last_change: float = float("-inf")
+    # Exponentially weighted share of refreshes that changed at least one route
+    volatility: float = 0.0
+    next_departure: Optional[datetime] = None
+    upcoming_route: Optional[dict] = None
+    failures: int = 0
+    # Changed while a refresh was already running, so it has to be refreshed again right after
+    changed_during_refresh: bool = False
+
+
+@dataclass(order=True)
+class _Entry:
+    due: float
+    day: date = field(compare=False)
+
+
+class RefreshScheduler:
+    """
+    Decides per day when to refresh it next, replacing fixed interval loops. Near-term, recently edited and volatile
+    days are refreshed often, stable far-future days rarely
+    """
+
+    def __init__(self, refresh: Callable[[date, Optional[str]], DayRefresh],
+                 today_executor: Executor, executor: Executor,
+                 sync: Callable[[], set[date]] = None,
+                 prefetch: Callable[[list[date]], None] = None,
+                 precompute: Callable[[dict[date, Optional[str]]], None] = None,
+                 upcoming_route_callback=lambda route: None) -> None:
+        self.refresh = refresh
+        self.today_executor = today_executor
+        self.executor = executor
+        self.sync = sync
+        self.prefetch = prefetch
+        self.precompute = precompute
+        self.upcoming_route_callback = upcoming_route_callback
+        self.states: dict[date, DayState] = {}
+        self._due: dict[date, float] = {}
+        self._heap: list[_Entry] = []
+        self._in_flight: set[date] = set()
+        self._recent_refreshes = deque()
+        self._next_sync = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @staticmethod
+    def horizon() -> list[date]:
+        """ Today, the rest of this week and the following PRE_CALC_WEEK_COUNT weeks """
+        today = date.today()
+        monday = today - timedelta(days=today.weekday())
+        last_day = monday + timedelta(days=7 * (current_profile().pre_calc_week_count + 1) - 1)
+        return [today + timedelta(days=i) for i in range((last_day - today).days + 1)]
+
+    def schedule(self, day: date, delay: float) -> None:
+        due = time.monotonic() + delay
+        # Only ever move a day forward in the queue, outdated heap entries are skipped when popped
+        if day in self._due and self._due[day] <= due:
+            return
+        self._due[day] = due
+        heapq.heappush(self._heap, _Entry(due, day))
+
+    def snapshot(self) -> dict[str, dict]:
+        """ What has to survive a restart (as JSON), so unchanged days aren't planned again """
+        return {
+            day.isoformat(): {"fingerprint": state.fingerprint, "volatility": state.volatility,
+                              "next_departure": state.next_departure.isoformat()
+                              if state.next_departure is not None else None}
+            for day, state in self.states.items() if state.fingerprint is not None
+        }
+
+    def restore(self, days: dict[str, dict]) -> None:
+        horizon = self.horizon()
+        for day, saved in days.items():
+            day = date.fromisoformat(day)
+            if day in horizon:
+                next_departure = saved["next_departure"]
+                self.states[day] = DayState(
+                    fingerprint=saved["fingerprint"], volatility=saved["volatility"],
+                    next_departure=datetime.fromisoformat(next_departure) if next_departure is not None else None)
+                # Still checked right away, but only planned again if the fingerprint changed
+                self.schedule(day, 0)
+
+    def mark_changed(self, days) -> None:
+        for day in days:
+            if day in self.states:
+                self.states[day].last_change = time.monotonic()
+                if day in self._in_flight:
+                    self.states[day].changed_during_refresh = True
+                else:
+                    self.schedule(day, 0)
+        self._wake()
+
+    def request_sync(self) -> None:
+        """ Thread-safe, e.g. for push notifications: sync the calendars as soon as possible """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._sync_now)
+
+    def _sync_now(self) -> None:
+        self._next_sync = 0.0
+        self._wake()
+
+    def _wake(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def interval(self, day: date, state: DayState) -> float:
+        if state.upcoming_route is not None:
+            return 60
+        days_ahead = (day - date.today()).days
+        interval = settings.SCHEDULER_BASE_INTERVAL * (1 + days_ahead)
+        if settings.PUSH_NOTIFICATIONS:
+            # Polling is only a fallback in case a notification got lost
+            interval *= settings.PUSH_FALLBACK_POLL_FACTOR
+        interval = min(interval, settings.SCHEDULER_MAX_INTERVAL)
+
+        # Delays matter more the closer the next departure is
+        if state.next_departure is not None:
+            time_until_departure = (state.next_departure - datetime.now(UTC)).total_seconds()
+            if time_until_departure > 0:
+                interval = min(interval, max(60.0, time_until_departure / 4))
+        # The user is probably still editing the day's events
+        if time.monotonic() - state.last_change < settings.SCHEDULER_EDIT_WINDOW:
+            interval = min(interval, 60.0)
+        interval *= 1 - 0.5 * state.volatility
+        # Back off on days that keep failing
+        interval *= 2 ** min(state.failures, 5)
+        return max(interval, 60.0)
+
+    def _update_horizon(self) -> None:
+        horizon = self.horizon()
+        for day in list(self.states):
+            if day not in horizon:
+                del self.states[day]
+                self._due.pop(day, None)
+        for day in horizon:
+            if day not in self.states:
+                self.states[day] = DayState()
+                self.schedule(day, 0)
+
+    def _budget_exhausted(self) -> bool:
+        now = time.monotonic()
+        while self._recent_refreshes and now - self._recent_refreshes[0] > 60 * 60:
+            self._recent_refreshes.popleft()
+        return len(self._recent_refreshes) >= settings.SCHEDULER_MAX_REFRESHES_PER_HOUR
+
+    async def _refresh(self, day: date, lag: float = 0.0) -> None:
+        state = self.states[day]
+        executor = self.today_executor if day == date.today() else self.executor
+        kind = "today" if day == date.today() else "later"
+        metrics.observe("commute_planner_refresh_lag_seconds", lag, day=kind)
+        start = time.monotonic()
+        result = None
+        try:
+            with metrics.span("refresh_day", day=kind):
+                result = await self._run_in_executor(executor, self.refresh, day, state.fingerprint,
+                                                     priority=self.priority(day, state))
+        except Exception as ex:
+            print(f"[{day}] Refresh failed: {ex}")
+            state.failures += 1
+            # The day may be half planned, so the retry plans it again even if its events are unchanged
+            state.fingerprint = None
+        else:
+            if state.fingerprint is not None and result.fingerprint != state.fingerprint:
+                state.last_change = time.monotonic()
+            state.fingerprint = result.fingerprint
+            state.volatility = 0.7 * state.volatility + 0.3 * (1 if result.changed_routes else 0)
+            state.next_departure = result.next_departure
+            state.upcoming_route = result.upcoming_route
+            state.failures = 0
+            if result.upcoming_route is not None and day == date.today():
+                self.upcoming_route_callback(result.upcoming_route)
+        finally:
+            self._in_flight.discard(day)
+            seconds = time.monotonic() - start
+            # The upcoming route is renewed every minute, a later refresh means a missed update
+            if kind == "today" and lag + seconds > 60:
+                metrics.increment("commute_planner_deadline_misses_total")
+            metrics.log("refresh", day=day.isoformat(), lag=round(lag, 3), seconds=round(seconds, 3),
+                        changed_routes=result.changed_routes if result is not None else None,
+                        failed=result is None)
+
+        if day in self.states:
+            self._due.pop(day, None)
+            self.schedule(day, 0 if state.changed_during_refresh else self.interval(day, state))
+            state.changed_during_refresh = False
+        self._wake()
+
+    @staticmethod
+    def priority(day: date, state: DayState) -> int:
+        """ Request priority of a refresh (see budget.py), the route the user takes next goes first """
+        if day == date.today():
+            departure_soon = (state.next_departure is not None and
+                              timedelta(0) < state.next_departure - datetime.now(UTC) < timedelta(hours=1))
+            return PRIORITY_UPCOMING if state.upcoming_route is not None or departure_soon else PRIORITY_TODAY
+        return priority_for_day((day - date.today()).days)
+
+    def _run_in_executor(self, executor: Executor, func, *args, priority: int = PRIORITY_TODAY):
+        # The callbacks see the scheduler's context, e.g. the user it plans for in service mode
+        return asyncio.get_running_loop().run_in_executor(
+            executor, functools.partial(contextvars.copy_context().run, prioritized(priority, func), *args))
+
+    def _dispatch(self, day: date, tasks: set, lag: float = 0.0) -> None:
+        task = asyncio.create_task(self._refresh(day, lag))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def _prepare_and_dispatch(self, days: list[date], tasks: set, lags: dict[date, float]) -> None:
+        start = time.monotonic()
+        priority = priority_for_day((min(days) - date.today()).days)
+        if self.prefetch is not None and len(days) > 1:
+            # Fetch the events of all due days at once instead of once per day
+            try:
+                await self._run_in_executor(self.executor, self.prefetch, days, priority=priority)
+            except Exception as ex:
+                print(f"Prefetching events failed: {ex}")
+        if self.precompute is not None and len(days) > 1:
+            # Routes shared between the due days (e.g. weekly lectures) are planned once for all of them. Days that
+            # are still planned as of their fingerprint (e.g. restored after a restart) are left out
+            known_fingerprints = {day: self.states[day].fingerprint for day in days if day in self.states}
+            try:
+                await self._run_in_executor(self.executor, self.precompute, known_fingerprints,
+                                            priority=PRIORITY_PRECOMPUTE)
+            except Exception as ex:
+                print(f"Precomputing recurring routes failed: {ex}")
+        for day in days:
+            if day in self.states:
+                self._dispatch(day, tasks, lags[day] + time.monotonic() - start)
+            else:
+                # Left the horizon in the meantime
+                self._in_flight.discard(day)
+
+    async def run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        tasks = set()
+
+        while 1:
+            with metrics.span("scheduler_iteration"):
+                self._wakeup.clear()
+                self._update_horizon()
+
+                if self.sync is not None and time.monotonic() >= self._next_sync:
+                    interval = settings.SCHEDULER_SYNC_INTERVAL
+                    if settings.PUSH_NOTIFICATIONS:
+                        interval *= settings.PUSH_FALLBACK_POLL_FACTOR
+                    self._next_sync = time.monotonic() + interval
+                    try:
+                        changed_days = await self._run_in_executor(self.today_executor, self.sync)
+                    except Exception as ex:
+                        print(f"Calendar sync failed: {ex}")
+                    else:
+                        self.mark_changed(changed_days)
+
+                due_days = []
+                lags = {}
+                while self._heap and self._heap[0].due <= time.monotonic():
+                    entry = heapq.heappop(self._heap)
+                    if self._due.get(entry.day, None) != entry.due or entry.day in self._in_flight:
+                        continue
+                    if entry.day != date.today() and self._budget_exhausted():
+                        # Today is always refreshed, other days have to wait for the budget
+                        self._due.pop(entry.day)
+                        self.schedule(entry.day, 60)
+                        continue
+                    self._recent_refreshes.append(time.monotonic())
+                    self._in_flight.add(entry.day)
+                    due_days.append(entry.day)
+                    lags[entry.day] = time.monotonic() - entry.due
+
+                if date.today() in due_days:
+                    # Today doesn't wait for the other days' prefetching and precomputation
+                    self._dispatch(date.today(), tasks, lags[date.today()])
+                other_days = [day for day in due_days if day != date.today()]
+                if other_days:
+                    # Runs in the background, so the loop keeps syncing and dispatching today in the meantime
+                    task = asyncio.create_task(self._prepare_and_dispatch(other_days, tasks, lags))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+            timeout = 60.0
+            if self._heap:
+                timeout = min(timeout, max(self._heap[0].due - time.monotonic(), 1.0))
+            if self.sync is not None:
+                timeout = min(timeout, max(self._next_sync - time.monotonic(), 1.0))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,104 @@
+"""
+Service mode: plans the routes of several users (see profiles.json / PROFILES_PATH) in one process. Every user has
+their own calendars, credentials, home and refresh schedule, while the location cache, route cache, travel matrix,
+connection pools and per-backend request limits are shared, so e.g. the rooms and connections of a shared lecture
+are only resolved once for everyone.
+
+Usage: python -m commute_planner.service [--login NAME]
+"""
+import argparse
+import asyncio
+import contextvars
+
+from .calendar_client import CalendarClient
+from .calendar_sync import CalendarSync
+from .concurrency import FairExecutor
+from .main import background_executor, precompute_recurring_legs, prefetch_days, run_blocking, update_day
+from .metrics import metrics
+from .planner_state import load_snapshot, save_snapshot
+from .profiles import load_profiles, Profile, use_profile
+from .route_api import route_cache
+from .scheduler import RefreshScheduler
+from . import settings
+
+# Shared by all users, but taking turns between them. Today has its own pool, like in single user mode
+today_executor = FairExecutor(max_workers=settings.SERVICE_TODAY_WORKER_COUNT, thread_name_prefix="service-today")
+day_executor = FairExecutor(max_workers=settings.REFRESH_WORKER_COUNT, thread_name_prefix="service-day")
+
+
+def sync_calendars():
+    return CalendarSync().sync_all()
+
+
+def create_scheduler(profile: Profile, saved_days: dict) -> RefreshScheduler:
+    def upcoming_route_callback(route):
+        print(f"[{profile.name}] Upcoming route: {route.get('summary', '')}")
+
+    scheduler = RefreshScheduler(
+        update_day, today_executor, day_executor,
+        sync=sync_calendars if settings.INCREMENTAL_SYNC else None,
+        prefetch=None if settings.INCREMENTAL_SYNC else prefetch_days,
+        precompute=precompute_recurring_legs,
+        upcoming_route_callback=upcoming_route_callback
+    )
+    scheduler.restore(saved_days)
+    return scheduler
+
+
+async def save_state(schedulers: dict[str, RefreshScheduler]):
+    # One snapshot for everyone, so the shared route cache is only saved once
+    days = {name: scheduler.snapshot() for name, scheduler in schedulers.items()}
+    routes = route_cache.snapshot()
+    try:
+        await run_blocking(background_executor, save_snapshot, days, routes, settings.SERVICE_STATE_PATH)
+    except OSError as ex:
+        print(f"Couldn't save the service state: {ex}")
+
+
+async def state_loop(schedulers: dict[str, RefreshScheduler]):
+    try:
+        while 1:
+            await asyncio.sleep(settings.PLANNER_STATE_SAVE_INTERVAL)
+            await save_state(schedulers)
+    finally:
+        await save_state(schedulers)
+
+
+async def serve(profiles: list[Profile]):
+    if settings.METRICS_ENDPOINT:
+        metrics.start_server()
+    snapshot = load_snapshot(settings.SERVICE_STATE_PATH)
+    if snapshot:
+        route_cache.restore(snapshot["routes"])
+
+    schedulers = {}
+    tasks = []
+    for profile in profiles:
+        # Each scheduler runs in its own context, so everything it calls (also in the executors) plans for its user
+        context = contextvars.copy_context()
+        context.run(use_profile, profile)
+        scheduler = context.run(create_scheduler, profile, snapshot.get("days", {}).get(profile.name, {}))
+        schedulers[profile.name] = scheduler
+        tasks.append(asyncio.create_task(scheduler.run(), context=context))
+    print(f"Planning routes for {len(profiles)} users")
+    await asyncio.gather(*tasks, state_loop(schedulers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plans the routes of several users in one process")
+    parser.add_argument("--login", metavar="NAME", help="Log in the given user (creates their token) and exit")
+    args = parser.parse_args()
+
+    profiles = load_profiles()
+    if args.login:
+        profile = next((profile for profile in profiles if profile.name == args.login), None)
+        if profile is None:
+            parser.error(f"Unknown profile {args.login}")
+        profile.bind(CalendarClient)()
+        print(f"Saved the credentials of {profile.name} to {profile.token_path}")
+        return
+    asyncio.run(serve(profiles))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,73 @@ MAIN_CALENDAR_ID = os.environ.get("MAIN_CALENDAR_ID")
 ROUTE_CALENDAR_ID = os.environ.get("ROUTE_CALENDAR_ID")
 TIME_MARGIN_BEFORE = float(os.environ.get("TIME_MARGIN_BEFORE_IN_MINUTES"))
 TIME_MARGIN_AFTER = float(os.environ.get("TIME_MARGIN_AFTER_IN_MINUTES"))
-HOME_POS = float(os.environ.get("HOME_LATITUDE")), float(os.environ.get("HOME_LONGITUDE"))
+# Optional in service mode, where every profile has its own home
+HOME_POS = (float(os.environ.get("HOME_LATITUDE")), float(os.environ.get("HOME_LONGITUDE"))) \
+    if os.environ.get("HOME_LATITUDE") else None
 MIN_ROUTE_DISTANCE = float(os.environ.get("MIN_ROUTE_DISTANCE_IN_KM"))
 PRE_CALC_WEEK_COUNT = int(os.environ.get("PRE_CALC_WEEK_COUNT"))
+
+LOCATION_CACHE_PATH = os.environ.get("LOCATION_CACHE_PATH", "location_cache.sqlite3")
+LOCATION_CACHE_TTL = float(os.environ.get("LOCATION_CACHE_TTL_IN_DAYS", 30)) * 24 * 60 * 60
+LOCATION_CACHE_NEGATIVE_TTL = float(os.environ.get("LOCATION_CACHE_NEGATIVE_TTL_IN_HOURS", 6)) * 60 * 60
+INCREMENTAL_SYNC = os.environ.get("INCREMENTAL_SYNC", "true").lower() == "true"
+BACKGROUND_WORKER_COUNT = int(os.environ.get("BACKGROUND_WORKER_COUNT", 2))
+REFRESH_WORKER_COUNT = int(os.environ.get("REFRESH_WORKER_COUNT", 4))
+MVG_CONCURRENCY = int(os.environ.get("MVG_CONCURRENCY", 2))
+DB_CONCURRENCY = int(os.environ.get("DB_CONCURRENCY", 1))
+TUM_CONCURRENCY = int(os.environ.get("TUM_CONCURRENCY", 2))
+GOOGLE_CONCURRENCY = int(os.environ.get("GOOGLE_CONCURRENCY", 4))
+ROUTE_CACHE_COORDINATE_PRECISION = int(os.environ.get("ROUTE_CACHE_COORDINATE_PRECISION", 4))
+ROUTE_CACHE_MIN_LEAD_TIME = float(os.environ.get("ROUTE_CACHE_MIN_LEAD_TIME_IN_MINUTES", 30)) * 60
+ROUTE_CACHE_TTL_FACTOR = float(os.environ.get("ROUTE_CACHE_TTL_FACTOR", 0.05))
+ROUTE_CACHE_MAX_TTL = float(os.environ.get("ROUTE_CACHE_MAX_TTL_IN_HOURS", 12)) * 60 * 60
+ROUTE_CACHE_SIZE = int(os.environ.get("ROUTE_CACHE_SIZE", 10000))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT_IN_SECONDS", 10))
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", 3))
+HTTP_BACKOFF_BASE = float(os.environ.get("HTTP_BACKOFF_BASE_IN_SECONDS", 0.5))
+HTTP_BACKOFF_CAP = float(os.environ.get("HTTP_BACKOFF_CAP_IN_SECONDS", 30))
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", 8))
+ROUTE_SEARCH_WINDOWS = int(os.environ.get("ROUTE_SEARCH_WINDOWS", 4))
+ROUTE_SEARCH_WINDOW_OFFSET = float(os.environ.get("ROUTE_SEARCH_WINDOW_OFFSET_IN_MINUTES", 30))
+# Push notifications require INCREMENTAL_SYNC to find out which days changed
+PUSH_NOTIFICATIONS = os.environ.get("PUSH_NOTIFICATIONS", "false").lower() == "true" and INCREMENTAL_SYNC
+PUSH_WEBHOOK_URL = os.environ.get("PUSH_WEBHOOK_URL")
+PUSH_LISTEN_HOST = os.environ.get("PUSH_LISTEN_HOST", "127.0.0.1")
+PUSH_LISTEN_PORT = int(os.environ.get("PUSH_LISTEN_PORT", 8080))
+PUSH_CHANNEL_TOKEN = os.environ.get("PUSH_CHANNEL_TOKEN", "")
+PUSH_DEBOUNCE = float(os.environ.get("PUSH_DEBOUNCE_IN_SECONDS", 10))
+PUSH_MAX_DEBOUNCE = float(os.environ.get("PUSH_MAX_DEBOUNCE_IN_SECONDS", 60))
+PUSH_FALLBACK_POLL_FACTOR = float(os.environ.get("PUSH_FALLBACK_POLL_FACTOR", 6))
+SCHEDULER_BASE_INTERVAL = float(os.environ.get("SCHEDULER_BASE_INTERVAL_IN_MINUTES", 5)) * 60
+SCHEDULER_MAX_INTERVAL = float(os.environ.get("SCHEDULER_MAX_INTERVAL_IN_MINUTES", 240)) * 60
+SCHEDULER_EDIT_WINDOW = float(os.environ.get("SCHEDULER_EDIT_WINDOW_IN_MINUTES", 15)) * 60
+SCHEDULER_SYNC_INTERVAL = float(os.environ.get("SCHEDULER_SYNC_INTERVAL_IN_MINUTES", 1)) * 60
+SCHEDULER_MAX_REFRESHES_PER_HOUR = int(os.environ.get("SCHEDULER_MAX_REFRESHES_PER_HOUR", 200))
+TRAVEL_MATRIX_PATH = os.environ.get("TRAVEL_MATRIX_PATH", "travel_matrix.sqlite3")
+TRAVEL_MATRIX_PRECISION = int(os.environ.get("TRAVEL_MATRIX_PRECISION", 3))
+TRAVEL_MATRIX_BUCKET_MINUTES = int(os.environ.get("TRAVEL_MATRIX_BUCKET_MINUTES", 60))
+LOCATION_SNAP_RADIUS = float(os.environ.get("LOCATION_SNAP_RADIUS_IN_KM", 0.05))
+GTFS_FEED_PATH = os.environ.get("GTFS_FEED_PATH")
+GTFS_OFFLINE_AFTER_DAYS = float(os.environ.get("GTFS_OFFLINE_AFTER_DAYS", 2))
+GTFS_TIMEZONE = os.environ.get("GTFS_TIMEZONE", "Europe/Berlin")
+GTFS_MAX_WALK_DISTANCE = float(os.environ.get("GTFS_MAX_WALK_DISTANCE_IN_KM", 1))
+GTFS_WALK_SPEED = float(os.environ.get("GTFS_WALK_SPEED_IN_KMH", 4.5))
+GTFS_WALK_DETOUR_FACTOR = float(os.environ.get("GTFS_WALK_DETOUR_FACTOR", 1.3))
+GTFS_TRANSFER_SECONDS = int(os.environ.get("GTFS_TRANSFER_SECONDS", 120))
+PLANNER_STATE_PATH = os.environ.get("PLANNER_STATE_PATH", "planner_state.json.gz")
+PLANNER_STATE_SAVE_INTERVAL = float(os.environ.get("PLANNER_STATE_SAVE_INTERVAL_IN_SECONDS", 60))
+TIMEZONE = os.environ.get("TIMEZONE", "Europe/Berlin")
+METRICS_ENDPOINT = os.environ.get("METRICS_ENDPOINT", "false").lower() == "true"
+METRICS_LISTEN_HOST = os.environ.get("METRICS_LISTEN_HOST", "127.0.0.1")
+METRICS_LISTEN_PORT = int(os.environ.get("METRICS_LISTEN_PORT", 9464))
+METRICS_LOG_PATH = os.environ.get("METRICS_LOG_PATH")
+PROFILES_PATH = os.environ.get("PROFILES_PATH", "profiles.json")
+SERVICE_STATE_PATH = os.environ.get("SERVICE_STATE_PATH", "service_state.json.gz")
+SERVICE_TODAY_WORKER_COUNT = int(os.environ.get("SERVICE_TODAY_WORKER_COUNT", 2))
+# Request budgets per backend, 0 disables a budget (the concurrency limits above still apply)
+MVG_REQUESTS_PER_MINUTE = float(os.environ.get("MVG_REQUESTS_PER_MINUTE", 60))
+DB_REQUESTS_PER_MINUTE = float(os.environ.get("DB_REQUESTS_PER_MINUTE", 20))
+TUM_REQUESTS_PER_MINUTE = float(os.environ.get("TUM_REQUESTS_PER_MINUTE", 120))
+GOOGLE_REQUESTS_PER_MINUTE = float(os.environ.get("GOOGLE_REQUESTS_PER_MINUTE", 300))
+REQUEST_BURST = int(os.environ.get("REQUEST_BURST", 10))
+RATE_LIMIT_PAUSE = float(os.environ.get("RATE_LIMIT_PAUSE_IN_SECONDS", 30))
@@ -0,0 +1,34 @@
+import threading
+from concurrent.futures import Future
+from typing import Hashable
+
+
+class SingleFlight:
+    """ Lets concurrent calls with the same key share one execution and its result """
+
+    def __init__(self) -> None:
+        self._calls: dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, func, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key, None)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
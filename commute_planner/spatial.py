@@ -0,0 +1,65 @@
+import math
+import threading
+
+from geopy import distance
+
+from . import settings
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def fast_distance(a, b) -> float:
+    """ Equirectangular approximation of the distance in km, accurate to well below 1% at city scale """
+    x = math.radians(b[1] - a[1]) * math.cos(math.radians((a[0] + b[0]) / 2))
+    y = math.radians(b[0] - a[0])
+    return EARTH_RADIUS_KM * math.hypot(x, y)
+
+
+def within_distance(a, b, kilometers: float) -> bool:
+    """ Whether a and b are at most `kilometers` apart, only computing the exact geodesic close to the threshold """
+    approximate = fast_distance(a, b)
+    if abs(approximate - kilometers) > kilometers * 0.01 + 0.005:
+        return approximate <= kilometers
+    return distance.distance(a, b).kilometers <= kilometers
+
+
+class SpatialIndex:
+    """ Grid index of known locations, snapping nearby coordinates to a shared canonical location """
+
+    def __init__(self, snap_radius: float) -> None:
+        self.snap_radius = snap_radius
+        self._cell_size = snap_radius / KM_PER_DEGREE
+        self._cells: dict[tuple[int, int], list[tuple[float, float]]] = {}
+        self._lock = threading.Lock()
+
+    def _cell(self, coordinates) -> tuple[int, int]:
+        return int(coordinates[0] // self._cell_size), int(coordinates[1] // self._cell_size)
+
+    def nearest(self, coordinates):
+        """ The closest known location within the snap radius, or None """
+        row, column = self._cell(coordinates)
+        # Longitude degrees are shorter than latitude degrees, so more columns have to be searched
+        column_range = math.ceil(1 / max(math.cos(math.radians(coordinates[0])), 0.01))
+        candidates = [
+            location
+            for i in range(row - 1, row + 2)
+            for j in range(column - column_range, column + column_range + 1)
+            for location in self._cells.get((i, j), ())
+        ]
+        nearest = min(candidates, key=lambda location: fast_distance(coordinates, location), default=None)
+        if nearest is None or fast_distance(coordinates, nearest) > self.snap_radius:
+            return None
+        return nearest
+
+    def snap(self, coordinates) -> tuple[float, float]:
+        coordinates = (float(coordinates[0]), float(coordinates[1]))
+        with self._lock:
+            nearest = self.nearest(coordinates)
+            if nearest is not None:
+                return nearest
+            self._cells.setdefault(self._cell(coordinates), []).append(coordinates)
+            return coordinates
+
+
+locations = SpatialIndex(settings.LOCATION_SNAP_RADIUS)
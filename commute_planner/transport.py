@@ -0,0 +1,79 @@
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .budget import parse_retry_after, throttle
+from .concurrency import backend_limit
+from .metrics import metrics
+from . import settings
+
+try:
+    # Optional, decodes large responses (e.g. DB's many verbindungen) several times faster than the json module
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def rate_limited(response: requests.Response) -> bool:
+    """ 429, or a 403/503 telling us when to come back (some backends use those for rate limiting) """
+    return response.status_code == 429 or (response.status_code in (403, 503) and "Retry-After" in response.headers)
+
+
+def _create_session() -> requests.Session:
+    session = requests.Session()
+    # Keep-alive connections per host, so only the first request to a backend pays for the TCP and TLS handshake
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=settings.HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = settings.USER_AGENT
+    return session
+
+
+session = _create_session()
+
+
+def backoff(attempt: int) -> float:
+    """ Exponential backoff with full jitter """
+    return random.uniform(0, min(settings.HTTP_BACKOFF_CAP, settings.HTTP_BACKOFF_BASE * 2 ** attempt))
+
+
+def request_json(method: str, url: str, backend: str, **kwargs):
+    """
+    Sends a request through the shared session and decodes the JSON response.
+    Connection errors, timeouts, retryable status codes and invalid JSON are retried up to HTTP_MAX_RETRIES times,
+    after that the last error is raised. Other error responses are raised right away (requests.HTTPError). Rate limit
+    responses also pause the backend's request budget (see budget.py), so the retry and every other request to the
+    backend wait for the limit instead of running into it again
+    """
+    kwargs.setdefault("timeout", settings.HTTP_TIMEOUT)
+    for attempt in range(settings.HTTP_MAX_RETRIES + 1):
+        try:
+            with backend_limit(backend):
+                response = session.request(method, url, **kwargs)
+                if rate_limited(response):
+                    throttle(backend, parse_retry_after(response.headers.get("Retry-After")))
+                    raise requests.HTTPError(f"{backend} responded with {response.status_code}", response=response)
+            if response.status_code in RETRYABLE_STATUS_CODES:
+                raise requests.HTTPError(f"{backend} responded with {response.status_code}", response=response)
+            if response.ok:
+                return json_loads(response.content)
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError, ValueError) as ex:
+            reason = str(ex.response.status_code) if getattr(ex, "response", None) is not None else type(ex).__name__
+            metrics.increment("commute_planner_backend_errors_total", backend=backend, reason=reason)
+            if attempt == settings.HTTP_MAX_RETRIES:
+                raise
+            print(f"[{backend}] Request failed ({ex}), retrying")
+            metrics.increment("commute_planner_backend_retries_total", backend=backend)
+            time.sleep(backoff(attempt))
+            continue
+        # Any other error (e.g. 404 for an unknown room) is the same when asked again
+        metrics.increment("commute_planner_backend_errors_total", backend=backend, reason=str(response.status_code))
+        response.raise_for_status()
+
+
+def is_not_found(ex: Exception) -> bool:
+    return isinstance(ex, requests.HTTPError) and ex.response is not None and ex.response.status_code == 404
@@ -0,0 +1,88 @@
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Optional
+
+import pytz
+
+from .calendar_client import singleton
+from . import spatial
+from . import settings
+
+
+def cell(coordinates) -> tuple[float, float]:
+    """ Nearby coordinates (e.g. different rooms of the same building) share a cell """
+    coordinates = spatial.locations.snap(coordinates)
+    return (round(coordinates[0], settings.TRAVEL_MATRIX_PRECISION),
+            round(coordinates[1], settings.TRAVEL_MATRIX_PRECISION))
+
+
+def time_bucket(time: datetime) -> tuple[int, int]:
+    # The APIs return times in different time zones (e.g. UTC from MVG), rush hours are in local time
+    time = time.astimezone(pytz.timezone(settings.TIMEZONE))
+    return time.weekday(), (time.hour * 60 + time.minute) // settings.TRAVEL_MATRIX_BUCKET_MINUTES
+
+
+@singleton
+class TravelMatrix:
+    """
+    Travel times between recurring locations, bucketed by weekday and time of day and learned from past routes. Used to
+    warn about transfers between events that can't be made in time, the routes themselves are always queried
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(settings.TRAVEL_MATRIX_PATH, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS travel_times ("
+            "origin_lat REAL NOT NULL, origin_lon REAL NOT NULL, "
+            "destination_lat REAL NOT NULL, destination_lon REAL NOT NULL, "
+            "weekday INTEGER NOT NULL, bucket INTEGER NOT NULL, "
+            "min_minutes REAL NOT NULL, mean_minutes REAL NOT NULL, samples INTEGER NOT NULL, "
+            "PRIMARY KEY (origin_lat, origin_lon, destination_lat, destination_lon, weekday, bucket))"
+        )
+        self._connection.commit()
+
+    def record(self, origin, destination, time: datetime, duration: timedelta) -> None:
+        minutes = duration.total_seconds() / 60
+        key = (*cell(origin), *cell(destination), *time_bucket(time))
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT min_minutes, mean_minutes, samples FROM travel_times WHERE origin_lat = ? AND origin_lon = ? "
+                "AND destination_lat = ? AND destination_lon = ? AND weekday = ? AND bucket = ?", key
+            ).fetchone()
+            if row is None:
+                values = (minutes, minutes, 1)
+            else:
+                # Exponential moving average, so timetable changes are picked up eventually
+                values = (min(row[0], minutes), 0.8 * row[1] + 0.2 * minutes, row[2] + 1)
+            self._connection.execute(
+                "INSERT OR REPLACE INTO travel_times VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (*key, *values))
+            self._connection.commit()
+
+    def minimum(self, origin, destination, time: datetime = None) -> Optional[timedelta]:
+        """
+        The fastest connection observed between two locations at the weekday and time of day of the given time, or at
+        any time if there is none (or no time is given)
+        """
+        with self._lock:
+            row = (None,)
+            if time is not None:
+                row = self._connection.execute(
+                    "SELECT min_minutes FROM travel_times WHERE origin_lat = ? AND origin_lon = ? "
+                    "AND destination_lat = ? AND destination_lon = ? AND weekday = ? AND bucket = ?",
+                    (*cell(origin), *cell(destination), *time_bucket(time))
+                ).fetchone() or (None,)
+            if row[0] is None:
+                row = self._connection.execute(
+                    "SELECT MIN(min_minutes) FROM travel_times WHERE origin_lat = ? AND origin_lon = ? "
+                    "AND destination_lat = ? AND destination_lon = ?", (*cell(origin), *cell(destination))
+                ).fetchone()
+        return timedelta(minutes=row[0]) if row[0] is not None else None
+
+    def is_feasible(self, origin, destination, departure: datetime, arrival: datetime) -> Optional[bool]:
+        """ Whether the trip fits between departure and arrival, None if the pair is unknown """
+        fastest = self.minimum(origin, destination, departure)
+        if fastest is None:
+            return None
+        return departure + fastest <= arrival
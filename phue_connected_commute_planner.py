@@ -1,11 +1,11 @@
 # This is an example of how to use the upcoming events callback
 
-from geopy.distance import distance
 from phue import Bridge
 from datetime import datetime, timezone
 
 from commute_planner.main import *
 from commute_planner.settings import HOME_POS, MIN_ROUTE_DISTANCE
+from commute_planner.spatial import within_distance
 
 
 def update_lamps(route):
@@ -13,7 +13,7 @@ def update_lamps(route):
     # check if start is at home (if not, triggering the lamps would be kinda dumb)
     start_coordinates = route["description"].split("\n")[0].split(" | ")[0].split(", ")
     start_coordinates = (float(start_coordinates[0]), float(start_coordinates[1]))
-    if distance(start_coordinates, HOME_POS).kilometers > MIN_ROUTE_DISTANCE:
+    if not within_distance(start_coordinates, HOME_POS, MIN_ROUTE_DISTANCE):
         return
     # decide which color to set
     departure_delta = datetime.fromisoformat(route["start"]["dateTime"]) - datetime.now(timezone.utc)
@@ -60,11 +60,8 @@ async def main():
     b = Bridge(BRIDGE_IP)
     b.connect()
 
-    await asyncio.gather(
-        update_today_loop(update_lamps),
-        update_week_except_today_loop(),
-        update_following_weeks()
-    )
+    scheduler = create_scheduler(update_lamps)
+    await asyncio.gather(scheduler.run(), state_loop(scheduler))
 
 
 if __name__ == "__main__":